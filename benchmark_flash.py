@@ -0,0 +1,211 @@
+"""Benchmarks of transpiler performance on FLASH source code.
+
+Run the default corpus with:
+
+    python3 -m unittest --verbose benchmark_flash
+
+Set BENCHMARK_CORPUS=large to also benchmark whole FLASH units (e.g. for nightly runs).
+"""
+
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import tempfile
+import time
+import typing as t
+import unittest
+
+from transpyle.general import CodeReader, CodeWriter
+from transpyle.fortran import FortranParser, FortranAstGeneralizer, Fortran2008Unparser
+
+import common
+from common import _RESULTS_ROOT, date_str, tracking_peak_rss, _read_peak_rss_kb
+from transpiling_flash import _transpyle_version, find_fortran_files
+
+logging.basicConfig()
+
+_LOG = logging.getLogger(__name__)
+
+_HERE = pathlib.Path(__file__).parent.resolve()
+
+common._NOW = datetime.datetime.now()
+
+STAGES = ('read', 'parse', 'generalize', 'unparse', 'write')
+
+_SPAWN = multiprocessing.get_context('spawn')
+
+_FLASH_4_FILES = [
+    'physics/Eos/EosMain/Gamma/eos_idealGamma.F90',
+    'physics/Hydro/HydroMain/split/MHD_8Wave/hy_8wv_fluxes.F90',
+    'physics/Hydro/HydroMain/split/MHD_8Wave/hy_8wv_interpolate.F90',
+    'physics/Hydro/HydroMain/split/MHD_8Wave/hy_8wv_sweep.F90',
+    'physics/Hydro/HydroMain/unsplit/hy_uhd_DataReconstructNormalDir_MH.F90',
+    'physics/Hydro/HydroMain/unsplit/hy_uhd_getFaceFlux.F90',
+    'physics/Hydro/HydroMain/unsplit/hy_uhd_Roe.F90',
+    'physics/Hydro/HydroMain/unsplit/hy_uhd_upwindTransverseFlux.F90']
+
+CORPUS = {
+    'flash-subset': (pathlib.Path('flash-subset', 'FLASH4.4', 'source'), [
+        'physics/Hydro/HydroMain/simpleUnsplit/HLL/hy_hllUnsplit.F90']),
+    'flash-4.4': (pathlib.Path('flash-4.4', 'source'), _FLASH_4_FILES),
+    'flash-4.5': (pathlib.Path('flash-4.5', 'source'), _FLASH_4_FILES)}
+
+LARGE_CORPUS = {
+    'flash-subset': (pathlib.Path('flash-subset', 'FLASH4.4', 'source'), ['physics/Hydro']),
+    'flash-4.4': (pathlib.Path('flash-4.4', 'source'), ['physics/Hydro', 'physics/Eos']),
+    'flash-4.5': (pathlib.Path('flash-4.5', 'source'), ['physics/Hydro', 'physics/Eos'])}
+
+
+def _benchmark_stages(path: pathlib.Path, output_dir: pathlib.Path) -> t.Dict[str, float]:
+    reader = CodeReader()
+    parser = FortranParser()
+    generalizer = FortranAstGeneralizer()
+    unparser = Fortran2008Unparser()
+    writer = CodeWriter(path.suffix)
+
+    times = {}
+    start = time.perf_counter()
+    code = reader.read_file(path)
+    times['read'] = time.perf_counter() - start
+    start = time.perf_counter()
+    fortran_ast = parser.parse(code, path)
+    times['parse'] = time.perf_counter() - start
+    start = time.perf_counter()
+    tree = generalizer.generalize(fortran_ast)
+    times['generalize'] = time.perf_counter() - start
+    start = time.perf_counter()
+    fortran_code = unparser.unparse(tree)
+    times['unparse'] = time.perf_counter() - start
+    start = time.perf_counter()
+    writer.write_file(fortran_code, output_dir.joinpath(path.name))
+    times['write'] = time.perf_counter() - start
+    return times
+
+
+def _benchmark_worker(path: pathlib.Path, output_dir: pathlib.Path, connection):
+    with tracking_peak_rss(os.getpid(), descendants_only=True) as parser_peak:
+        try:
+            times = _benchmark_stages(path, output_dir)
+            error = None
+        except Exception as err:  # reported back to the parent process
+            times = None
+            error = '{}: {}'.format(type(err).__name__, err)
+    connection.send({
+        'times': times, 'error': error, 'peak_rss_kb': _read_peak_rss_kb(os.getpid()),
+        'parser_peak_rss_kb': parser_peak['peak_rss_kb']})
+    connection.close()
+
+
+def benchmark_file(path: pathlib.Path) -> dict:
+    """Time each transpilation stage on one file, in a fresh process to measure its peak memory.
+
+    The process is spawned rather than forked, so that its memory does not include the memory
+    of the benchmarking process. Peak RSS is taken from VmHWM, for the same reason.
+    Original file is not modified -- transpiled code is written into a temporary directory.
+    Result has stage times in seconds, peak RSS of the transpiler and of the external parser
+    in kilobytes, and size of the file in bytes and lines.
+    """
+    code = path.read_bytes()
+    with tempfile.TemporaryDirectory() as output_dir:
+        parent_connection, child_connection = _SPAWN.Pipe(duplex=False)
+        process = _SPAWN.Process(target=_benchmark_worker,
+                                 args=(path, pathlib.Path(output_dir), child_connection))
+        process.start()
+        child_connection.close()
+        try:
+            result = parent_connection.recv()
+        except EOFError:
+            result = {'times': None, 'peak_rss_kb': None, 'parser_peak_rss_kb': None,
+                      'error': 'benchmark process crashed'}
+        process.join()
+    result.update(path=str(path), bytes=len(code), lines=code.count(b'\n'))
+    return result
+
+
+def benchmark_corpus(corpus: t.Dict[str, t.Tuple[pathlib.Path, t.List[str]]]) -> t.List[dict]:
+    results = []
+    for app_name, (source_path, paths) in corpus.items():
+        absolute_paths = find_fortran_files(
+            pathlib.Path(_HERE, source_path, path) for path in paths)
+        for path in absolute_paths:
+            if not path.is_file():
+                _LOG.warning('%s: "%s" is missing, skipping it', app_name, path)
+                continue
+            result = benchmark_file(path)
+            result['app_name'] = app_name
+            _LOG.info('%s: %s', path, result)
+            results.append(result)
+    return results
+
+
+def benchmark_path(date=None) -> pathlib.Path:
+    return _RESULTS_ROOT.joinpath('benchmark_{}_transpyle-{}.json'.format(
+        date_str(date), _transpyle_version()))
+
+
+def summarize_benchmark(results: t.List[dict]) -> t.Dict[str, dict]:
+    """Compute throughput (lines per second) and total time of each stage over all files."""
+    succeeded = [result for result in results if result['times'] is not None]
+    lines = sum(result['lines'] for result in succeeded)
+    summary = {}
+    for stage in STAGES:
+        total_time = sum(result['times'][stage] for result in succeeded)
+        summary[stage] = {'time': total_time,
+                          'lines_per_second': lines / total_time if total_time else None}
+    summary['files'] = {'succeeded': len(succeeded), 'failed': len(results) - len(succeeded)}
+    return summary
+
+
+def compare_benchmarks(old_path: pathlib.Path, new_path: pathlib.Path) -> t.Dict[str, float]:
+    """Compute per-stage throughput ratio of new to old benchmark, using files common to both.
+
+    Ratio below 1 means that the new version is slower.
+    """
+    with old_path.open() as old_file, new_path.open() as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    old_results = {_['path']: _ for _ in old['results'] if _['times'] is not None}
+    new_results = {_['path']: _ for _ in new['results'] if _['times'] is not None}
+    common_paths = set(old_results) & set(new_results)
+    old_summary = summarize_benchmark([old_results[_] for _ in common_paths])
+    new_summary = summarize_benchmark([new_results[_] for _ in common_paths])
+    return {stage: new_summary[stage]['lines_per_second'] / old_summary[stage]['lines_per_second']
+            for stage in STAGES if old_summary[stage]['lines_per_second']
+            and new_summary[stage]['lines_per_second']}
+
+
+class TranspilerBenchmarks(unittest.TestCase):
+
+    corpus = CORPUS
+
+    @classmethod
+    def setUpClass(cls):
+        if os.environ.get('BENCHMARK_CORPUS') == 'large':
+            cls.corpus = LARGE_CORPUS
+
+    def run_benchmark(self, app_name):
+        source_path, paths = self.corpus[app_name]
+        if not pathlib.Path(_HERE, source_path).is_dir():
+            self.skipTest('{} is not available'.format(app_name))
+        results = benchmark_corpus({app_name: (source_path, paths)})
+        self.assertTrue(results)
+        summary = summarize_benchmark(results)
+        output_path = benchmark_path()
+        output_path = output_path.with_name(output_path.stem + '_' + app_name + '.json')
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with output_path.open('w') as output_file:
+            json.dump({'transpyle_version': _transpyle_version(), 'app_name': app_name,
+                       'summary': summary, 'results': results}, output_file, indent=2)
+        _LOG.warning('%s: %s, results written to "%s"', app_name, summary, output_path)
+        self.assertGreater(summary['files']['succeeded'], 0, msg=results)
+
+    def test_flash_subset(self):
+        self.run_benchmark('flash-subset')
+
+    def test_flash_44(self):
+        self.run_benchmark('flash-4.4')
+
+    def test_flash_45(self):
+        self.run_benchmark('flash-4.5')
@@ -1,7 +1,24 @@
 
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import fcntl
+import hashlib
+import json
 import logging
+import os
 import pathlib
+import platform
+import resource
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import typing as t
 
 _NOW = None
@@ -12,6 +29,16 @@ _HERE = pathlib.Path(__file__).parent.resolve()
 
 _RESULTS_ROOT = pathlib.Path(_HERE, 'results')
 
+_BUILD_CACHE_ROOT = pathlib.Path(_HERE, 'build_cache')
+
+_STRUCT_CACHE_ROOT = pathlib.Path(_HERE, 'struct_cache')
+
+_SPACK_ENVIRONMENT_CACHE_ROOT = pathlib.Path(_HERE, 'spack_environment_cache')
+
+_BUILD_KEY_FILENAME = '.flash_build_key'
+
+BUILD_CACHE_MAX_SIZE = 32 * 1024 ** 3
+
 
 # warsaw.m.gsic.titech.ac.jp:
 # CROSS_F77_SIZEOF_INTEGER=4 spack install mpich
@@ -38,9 +65,17 @@ ENVIRONMENT = {
 HPCRUN_EXE = 'hpcrun'  # shutil.which('hpcrun')
 HPCSTRUCT_EXE = 'hpcstruct'  # shutil.which('hpcstruct')
 HPCPROF_EXE = 'hpcprof'  # shutil.which('hpcprof')
+HPCPROF_MPI_EXE = 'hpcprof-mpi'  # shutil.which('hpcprof-mpi')
 
 FLASH_SITE = 'spack'
 
+FORTRAN_SUFFIXES = ('.F90', '.f90')
+
+# environment variables that influence the result of FLASH setup and make
+BUILD_ENVIRONMENT_VARIABLES = (
+    'PATH', 'LD_LIBRARY_PATH', 'LIBRARY_PATH', 'CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH',
+    'AMREX_PATH', 'CC', 'CXX', 'FC', 'F77', 'F90', 'CFLAGS', 'FFLAGS', 'LDFLAGS')
+
 
 def date_str(date=None) -> str:
     if date is None:
@@ -61,25 +96,702 @@ def profile_db_path(date=None, *, test_name) -> pathlib.Path:
     return profile_dir.with_name(profile_dir.name + '_db')
 
 
-def _run_and_check(cmd: t.Union[str, t.List[str]], wd: pathlib.Path, *,
-                   test_name: str, phase_name: str):
+def sampling_path(date=None, *, test_name) -> pathlib.Path:
+    profile_dir = profile_path(date, test_name=test_name)
+    return profile_dir.with_name(profile_dir.name + '_sampling.json')
+
+
+def phases_path() -> pathlib.Path:
+    return _RESULTS_ROOT.joinpath('phases.jsonl')
+
+
+def _record_phase(*, test_name: str, phase_name: str, wall_time: float, user_time: float,
+                  system_time: float, peak_rss_kb: int, returncode: t.Optional[int], **kwargs):
+    record = {
+        'date': date_str() if _NOW is not None else None,
+        'timestamp': datetime.datetime.now().isoformat(),
+        'test_name': test_name, 'phase_name': phase_name,
+        'wall_time': wall_time, 'cpu_time': user_time + system_time,
+        'user_time': user_time, 'system_time': system_time,
+        'peak_rss_kb': peak_rss_kb, 'returncode': returncode}
+    record.update(kwargs)
+    _RESULTS_ROOT.mkdir(parents=True, exist_ok=True)
+    with phases_path().open('a') as phases_file:
+        phases_file.write(json.dumps(record) + '\n')
+
+
+# resource usage of phases open in each thread, see timed_phase()
+_ACTIVE_PHASES = threading.local()
+
+
+def _account_usage(user_time: float, system_time: float, peak_rss_kb: t.Optional[int]):
+    """Add resource usage of a finished command to all phases open in the current thread."""
+    for usage in getattr(_ACTIVE_PHASES, 'stack', ()):
+        usage['user_time'] += user_time
+        usage['system_time'] += system_time
+        if peak_rss_kb is not None:
+            usage['peak_rss_kb'] = max(usage['peak_rss_kb'] or 0, peak_rss_kb)
+
+
+@contextlib.contextmanager
+def timed_phase(*, test_name: str, phase_name: str):
+    """Record wall time and resource usage of commands run in a block of code as a phase.
+
+    CPU time and peak RSS are those of commands run by _run_and_check() or wait_for_process()
+    in the current thread within the block, so that phases of concurrent threads don't mix.
+    Peak RSS is None if no command was run. Return code is 0 if the block succeeds
+    and None if it raises, unless it is set in the yielded dict.
+    """
+    if not hasattr(_ACTIVE_PHASES, 'stack'):
+        _ACTIVE_PHASES.stack = []
+    usage = {'user_time': 0.0, 'system_time': 0.0, 'peak_rss_kb': None}
+    _ACTIVE_PHASES.stack.append(usage)
+    start = time.perf_counter()
+    phase = {}
+    try:
+        yield phase
+        phase.setdefault('returncode', 0)
+    finally:
+        wall_time = time.perf_counter() - start
+        _ACTIVE_PHASES.stack.remove(usage)
+        _record_phase(test_name=test_name, phase_name=phase_name, wall_time=wall_time,
+                      returncode=phase.get('returncode'), **usage)
+
+
+def load_phases(path: pathlib.Path = None) -> t.List[dict]:
+    if path is None:
+        path = phases_path()
+    if not path.is_file():
+        return []
+    with path.open() as phases_file:
+        return [json.loads(line) for line in phases_file if line.strip()]
+
+
+def summarize_phases(records: t.List[dict] = None,
+                     group_by: t.Sequence[str] = ('phase_name',)) -> t.Dict[tuple, dict]:
+    """Aggregate phase records (by default all recorded so far) into per-group statistics."""
+    if records is None:
+        records = load_phases()
+    groups = collections.OrderedDict()
+    for record in records:
+        groups.setdefault(tuple(record.get(_) for _ in group_by), []).append(record)
+    summary = collections.OrderedDict()
+    for key, group in groups.items():
+        wall_times = [record['wall_time'] for record in group]
+        cpu_times = [record['cpu_time'] for record in group]
+        summary[key] = {
+            'count': len(group),
+            'failed': sum(record['returncode'] != 0 for record in group),
+            'wall_time_total': sum(wall_times), 'wall_time_mean': sum(wall_times) / len(group),
+            'wall_time_max': max(wall_times),
+            'cpu_time_total': sum(cpu_times), 'cpu_time_mean': sum(cpu_times) / len(group),
+            'peak_rss_kb': max((record['peak_rss_kb'] for record in group
+                                if record['peak_rss_kb'] is not None), default=None)}
+    return summary
+
+
+MONITOR_INTERVAL = 0.5
+
+MONITOR_FIELDS = ('timestamp', 'pid', 'ppid', 'rank', 'command', 'rss_kb', 'cpu',
+                  'voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches', 'read_bytes',
+                  'write_bytes')
+
+_MPI_RANK_VARIABLES = (b'PMI_RANK', b'OMPI_COMM_WORLD_RANK', b'PMIX_RANK')
+
+
+def _read_proc_stat(pid: int) -> t.Optional[dict]:
+    try:
+        stat = pathlib.Path('/proc', str(pid), 'stat').read_text()
+    except OSError:
+        return None
+    fields = stat[stat.rindex(')') + 2:].split()
+    return {'pid': pid, 'ppid': int(fields[1]),
+            'command': stat[stat.index('(') + 1:stat.rindex(')')],
+            'cpu_ticks': int(fields[11]) + int(fields[12]),
+            'rss_kb': int(fields[21]) * resource.getpagesize() // 1024}
+
+
+def _read_proc_counters(pid: int) -> t.Dict[str, int]:
+    counters = {}
+    for file_name, names in (
+            ('status', ('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches', 'VmHWM')),
+            ('io', ('read_bytes', 'write_bytes'))):
+        try:
+            lines = pathlib.Path('/proc', str(pid), file_name).read_text().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            name, _, value = line.partition(':')
+            if name in names:
+                counters[name] = int(value.split()[0])
+    return counters
+
+
+def _read_mpi_rank(pid: int) -> t.Optional[int]:
+    try:
+        environ = pathlib.Path('/proc', str(pid), 'environ').read_bytes()
+    except OSError:
+        return None
+    for variable in environ.split(b'\0'):
+        name, _, value = variable.partition(b'=')
+        if name in _MPI_RANK_VARIABLES:
+            return int(value)
+    return None
+
+
+# whether the kernel lists children of each thread in /proc/<pid>/task/<tid>/children
+_PROC_CHILDREN = pathlib.Path('/proc', str(os.getpid()), 'task', str(os.getpid()),
+                              'children').exists()
+
+
+def _process_tree_pids(pid: int) -> t.List[int]:
+    """List a process and all its descendants, parents first.
+
+    Only the tree is walked, unless the kernel doesn't list children of processes in /proc,
+    in which case parents of all processes are read.
+    """
+    tree = [pid]
+    if not _PROC_CHILDREN:
+        children = collections.defaultdict(list)
+        for path in pathlib.Path('/proc').iterdir():
+            if path.name.isdigit():
+                process = _read_proc_stat(int(path.name))
+                if process is not None:
+                    children[process['ppid']].append(process['pid'])
+        for tree_pid in tree:
+            tree += children[tree_pid]
+        return tree
+    for tree_pid in tree:
+        try:
+            tids = os.listdir('/proc/{}/task'.format(tree_pid))
+        except OSError:
+            continue
+        for tid in tids:
+            try:
+                with open('/proc/{}/task/{}/children'.format(tree_pid, tid)) as children_file:
+                    tree += [int(_) for _ in children_file.read().split()]
+            except OSError:
+                continue
+    return tree
+
+
+def _sample_process_tree(pid: int) -> t.List[dict]:
+    tree = [_read_proc_stat(_) for _ in _process_tree_pids(pid)]
+    return [process for process in tree if process is not None]
+
+
+@contextlib.contextmanager
+def monitor_process_tree(pid: int, path: pathlib.Path, interval: float = MONITOR_INTERVAL):
+    """Sample resource usage of a process and all its descendants from /proc, in a thread.
+
+    Every interval seconds, one CSV row per process is appended to the file at path, see
+    MONITOR_FIELDS. CPU is utilisation (in cores) since the previous sample of the process,
+    RSS is in kilobytes, and context switches and I/O bytes are cumulative. MPI rank is taken
+    from the environment of the process, if it is an MPI rank.
+
+    Yield a dict, in which "peak_rss_kb" is the peak RSS of the tree observed so far, the same
+    as tracking_peak_rss() does, so that the tree needn't be sampled twice.
+    """
+    stop = threading.Event()
+    ranks = {}
+    previous = {}
+    peak = {'peak_rss_kb': None}
+
+    def sample(writer):
+        while True:
+            timestamp = time.time()
+            for process in _sample_process_tree(pid):
+                key = (process['pid'], process['command'])
+                if key not in ranks:
+                    ranks[key] = _read_mpi_rank(process['pid'])
+                cpu = None
+                if key in previous:
+                    previous_timestamp, previous_ticks = previous[key]
+                    cpu = (process['cpu_ticks'] - previous_ticks) / os.sysconf('SC_CLK_TCK') \
+                        / (timestamp - previous_timestamp)
+                previous[key] = (timestamp, process['cpu_ticks'])
+                counters = _read_proc_counters(process['pid'])
+                if 'VmHWM' in counters:
+                    peak['peak_rss_kb'] = max(peak['peak_rss_kb'] or 0, counters['VmHWM'])
+                row = dict(process, timestamp='{:.3f}'.format(timestamp), rank=ranks[key],
+                           cpu=None if cpu is None else '{:.3f}'.format(cpu), **counters)
+                writer.writerow(row)
+            if stop.wait(interval):
+                break
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('a', newline='') as monitor_file:
+        writer = csv.DictWriter(monitor_file, MONITOR_FIELDS, extrasaction='ignore')
+        if monitor_file.tell() == 0:
+            writer.writeheader()
+        sampler = threading.Thread(target=sample, args=(writer,))
+        sampler.start()
+        try:
+            yield peak
+        finally:
+            stop.set()
+            sampler.join()
+
+
+def monitor_path(date=None, *, test_name, phase_name) -> pathlib.Path:
+    return logs_path(date, test_name=test_name).joinpath('{}_monitor.csv'.format(phase_name))
+
+
+PEAK_RSS_INTERVAL = 0.5
+
+
+def _read_peak_rss_kb(pid: int) -> t.Optional[int]:
+    try:
+        lines = pathlib.Path('/proc', str(pid), 'status').read_text().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        if line.startswith('VmHWM:'):
+            return int(line.split()[1])
+    return None
+
+
+@contextlib.contextmanager
+def tracking_peak_rss(pid: int, interval: float = PEAK_RSS_INTERVAL,
+                      descendants_only: bool = False):
+    """Track peak RSS of a process tree, i.e. the largest VmHWM of any of its processes.
+
+    Yield a dict, in which "peak_rss_kb" is the peak observed so far (None if none was).
+    Unlike ru_maxrss, VmHWM does not include memory of the parent process at fork, but
+    processes that live shorter than interval seconds may be missed.
+    If descendants_only is True, the process pid itself is not tracked.
+    """
+    stop = threading.Event()
+    peak = {'peak_rss_kb': None}
+
+    def track():
+        while True:
+            for tree_pid in _process_tree_pids(pid)[1 if descendants_only else 0:]:
+                peak_rss_kb = _read_peak_rss_kb(tree_pid)
+                if peak_rss_kb is not None:
+                    peak['peak_rss_kb'] = max(peak['peak_rss_kb'] or 0, peak_rss_kb)
+            if stop.wait(interval):
+                break
+
+    tracker = threading.Thread(target=track)
+    tracker.start()
+    try:
+        yield peak
+    finally:
+        stop.set()
+        tracker.join()
+
+
+def wait_for_process(process: subprocess.Popen, timeout: float = None,
+                     peak: t.Optional[dict] = None) -> dict:
+    """Wait for a process and return its return code, CPU time and peak RSS of its process tree.
+
+    Peak RSS is taken from peak, if the process is already tracked by tracking_peak_rss()
+    or monitor_process_tree(), and tracked with tracking_peak_rss() otherwise.
+    Usage is also added to phases open in the current thread, see timed_phase().
+    Raise subprocess.TimeoutExpired if the process doesn't finish within timeout seconds;
+    the process is left running.
+    """
+    deadline = None if timeout is None else time.perf_counter() + timeout
+    with contextlib.ExitStack() as stack:
+        if peak is None:
+            peak = stack.enter_context(tracking_peak_rss(process.pid))
+        while True:
+            pid, status, usage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+            if pid:
+                break
+            if time.perf_counter() > deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            time.sleep(PEAK_RSS_INTERVAL)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+        else os.WEXITSTATUS(status)
+    _account_usage(usage.ru_utime, usage.ru_stime, peak['peak_rss_kb'])
+    return {'returncode': process.returncode, 'user_time': usage.ru_utime,
+            'system_time': usage.ru_stime, 'peak_rss_kb': peak['peak_rss_kb']}
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+TAIL_LINE_LENGTH = 1024
+
+
+def _stream_output(pipe: t.BinaryIO, log_file: t.BinaryIO,
+                   tail: t.Optional[collections.deque] = None, echo: t.Optional[t.TextIO] = None):
+    """Copy output of a command into a log file chunk by chunk, and keep its last lines in tail.
+
+    Lines kept in tail are truncated to TAIL_LINE_LENGTH bytes, so that memory use stays bounded
+    even if the command writes a lot of output without line breaks.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    line = b''
+    while True:
+        chunk = pipe.read1(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        log_file.write(chunk)
+        if tail is not None:
+            *lines, rest = chunk.split(b'\n')
+            for part in lines:
+                tail.append((line + part)[:TAIL_LINE_LENGTH] + b'\n')
+                line = b''
+            line = (line + rest)[:TAIL_LINE_LENGTH]
+        if echo is not None:
+            echo.write(decoder.decode(chunk))
+            echo.flush()
+    if tail is not None and line:
+        tail.append(line)
+    pipe.close()
+
+
+def _run_and_check(cmd: t.Union[str, t.List[str]], wd: pathlib.Path,
+                   env: t.Optional[t.Mapping[str, str]] = None, *,
+                   test_name: str, phase_name: str, live_output: bool = False,
+                   monitor: bool = False):
+    """Run a command (in given environment, if any) and assert that it succeeds.
+
+    Output is streamed into "{phase_name}_stdout.log" and "{phase_name}_stderr.log" files
+    as the command runs, and only the last 50 lines of stderr (each truncated to
+    TAIL_LINE_LENGTH bytes) are kept in memory.
+    Wall time, CPU time, peak RSS and return code of the command are recorded as a phase,
+    see wait_for_process().
+    If live_output is True, output is also echoed to stdout and stderr of this process.
+    If monitor is True, resource usage of the command's process tree is recorded, see
+    monitor_process_tree() and monitor_path().
+    """
     cmd = cmd if isinstance(cmd, str) else ' '.join(cmd)
 
     _LOG.warning('%s.%s: running "%s" with wd="%s"', test_name, phase_name, cmd, wd)
-    cmd_result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                shell=True, cwd=str(wd))
+    log_dir = pathlib.Path(logs_path(test_name=test_name))
+    log_dir.mkdir(parents=True, exist_ok=True)
+    stderr_tail = collections.deque(maxlen=50)
+    with pathlib.Path(log_dir, '{}_stdout.log'.format(phase_name)).open('wb') as cmd_stdout_file, \
+            pathlib.Path(log_dir, '{}_stderr.log'.format(phase_name)).open('wb') as cmd_stderr_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   shell=True, cwd=str(wd), env=env)
+        streams = [
+            threading.Thread(target=_stream_output, args=(
+                process.stdout, cmd_stdout_file, None, sys.stdout if live_output else None)),
+            threading.Thread(target=_stream_output, args=(
+                process.stderr, cmd_stderr_file, stderr_tail,
+                sys.stderr if live_output else None))]
+        for stream in streams:
+            stream.start()
+        with contextlib.ExitStack() as stack:
+            peak = None
+            if monitor:
+                peak = stack.enter_context(monitor_process_tree(process.pid, monitor_path(
+                    test_name=test_name, phase_name=phase_name)))
+            result = wait_for_process(process, peak=peak)
+        for stream in streams:
+            stream.join()
+        wall_time = time.perf_counter() - start
+    returncode = result.pop('returncode')
+    _record_phase(test_name=test_name, phase_name=phase_name, wall_time=wall_time,
+                  returncode=returncode, command=cmd, **result)
     cmd_msg = None
-    if cmd_result.returncode != 0:
-        log_dir = pathlib.Path(logs_path(test_name=test_name))
-        log_dir.mkdir(parents=True, exist_ok=True)
-        cmd_stdout = cmd_result.stdout.decode()
-        with pathlib.Path(log_dir, '{}_stdout.log'.format(phase_name)).open('w') as cmd_stdout_file:
-            cmd_stdout_file.write(cmd_stdout)
-        cmd_stderr = cmd_result.stderr.decode()
-        with pathlib.Path(log_dir, '{}_stderr.log'.format(phase_name)).open('w') as cmd_stderr_file:
-            cmd_stderr_file.write(cmd_stderr)
+    if returncode != 0:
         cmd_msg = '"{}" failed, returncode={}, logs were written to "{}"' \
             ' and last 50 lines of stderr follow:\n{}'.format(
-                cmd, cmd_result.returncode, log_dir,
-                ''.join(cmd_stderr.splitlines(keepends=True)[-50:]))
-    assert cmd_result.returncode == 0, cmd_msg
+                cmd, returncode, log_dir, b''.join(stderr_tail).decode(errors='replace'))
+    assert returncode == 0, cmd_msg
+
+
+def run_on_cores(jobs: t.Sequence[t.Tuple[int, t.Callable[..., t.Any]]],
+                 cores: t.Sequence[int] = None) -> t.List[t.Any]:
+    """Run jobs concurrently so that each has its own cores, and return their results in order.
+
+    Each job is a pair: number of cores it needs and a function that is called with the list
+    of cores assigned to it as "cores" keyword argument. Jobs needing more cores are started first.
+    By default, all cores this process may use are available.
+    """
+    cores = sorted(os.sched_getaffinity(0) if cores is None else cores)
+    pending = sorted(range(len(jobs)), key=lambda i: jobs[i][0], reverse=True)
+    free_cores = list(cores)
+    running = {}
+    results = [None] * len(jobs)
+    with concurrent.futures.ThreadPoolExecutor(len(cores)) as executor:
+        while pending or running:
+            for i in list(pending):
+                needed_cores = min(max(jobs[i][0], 1), len(cores))
+                if needed_cores > len(free_cores):
+                    continue
+                assigned_cores, free_cores = free_cores[:needed_cores], free_cores[needed_cores:]
+                _LOG.info('starting job %i on cores %s', i, assigned_cores)
+                running[executor.submit(jobs[i][1], cores=assigned_cores)] = (i, assigned_cores)
+                pending.remove(i)
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i, assigned_cores = running.pop(future)
+                free_cores += assigned_cores
+                results[i] = future.result()
+    return results
+
+
+def _hash_file(path: pathlib.Path) -> str:
+    file_hash = hashlib.sha256()
+    with path.open('rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def flash_dimensionality(flash_args: t.Union[str, t.Sequence[str]]) -> str:
+    """Dimensionality ("1d", "2d" or "3d") of FLASH set up with given arguments of setup."""
+    if isinstance(flash_args, str):
+        flash_args = flash_args.split(' ')
+    for dimensionality in ('1d', '2d', '3d'):
+        if '-{}'.format(dimensionality) in flash_args:
+            return dimensionality
+    return '2d'
+
+
+def _spack_root() -> t.Optional[pathlib.Path]:
+    if 'SPACK_ROOT' in os.environ:
+        return pathlib.Path(os.environ['SPACK_ROOT'])
+    spack_exe = shutil.which('spack')
+    if spack_exe is None:
+        return None
+    return pathlib.Path(spack_exe).resolve().parent.parent
+
+
+_SPACK_ENVIRONMENTS = {}
+
+
+def spack_environment(dimensionality: str, host: str = None) -> t.Optional[t.Dict[str, str]]:
+    """Get environment for FLASH with Spack packages loaded, as given in ENVIRONMENT.
+
+    Running "spack load" takes seconds, so each environment is resolved once and cached,
+    in memory and as a difference to the current environment in "spack_environment_cache" folder.
+    The cache key covers: host, dimensionality, the load command, state of Spack database
+    and build-related environment variables, see BUILD_ENVIRONMENT_VARIABLES.
+
+    Return None (i.e. the current environment) if there is nothing to load for the host,
+    or if Spack is not available.
+    """
+    if host is None:
+        host = platform.node()
+    command = ENVIRONMENT.get(host, {}).get(dimensionality)
+    spack_root = _spack_root()
+    if not command:
+        return None
+    if spack_root is None:
+        _LOG.warning('Spack is not available, using current environment instead of "%s".',
+                     command)
+        return None
+    spack_db_path = spack_root.joinpath('opt', 'spack', '.spack-db', 'index.json')
+    key_data = {
+        'host': host,
+        'dimensionality': dimensionality,
+        'command': command,
+        'spack_db': [spack_db_path.stat().st_mtime_ns, spack_db_path.stat().st_size]
+                    if spack_db_path.is_file() else None,
+        'environment': {name: os.environ.get(name) for name in BUILD_ENVIRONMENT_VARIABLES}}
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+    if key in _SPACK_ENVIRONMENTS:
+        return _SPACK_ENVIRONMENTS[key]
+    cache_path = _SPACK_ENVIRONMENT_CACHE_ROOT.joinpath('{}.json'.format(key))
+    if cache_path.is_file():
+        with cache_path.open() as cache_file:
+            difference = json.load(cache_file)
+    else:
+        _LOG.warning('Resolving Spack environment "%s"...', command)
+        result = subprocess.run(
+            ['bash', '-c', '. "{}" && {} && env -0'.format(
+                spack_root.joinpath('share', 'spack', 'setup-env.sh'), command)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        loaded = dict(variable.partition('=')[::2]
+                      for variable in result.stdout.decode().split('\0') if variable)
+        # shell internals and exported shell functions (e.g. "spack") are left as they are
+        ignored = {name for name in set(loaded) | set(os.environ)
+                   if name in ('SHLVL', '_', 'PWD', 'OLDPWD') or name.startswith('BASH_FUNC_')}
+        difference = {
+            'set': {name: value for name, value in loaded.items()
+                    if name not in ignored and os.environ.get(name) != value},
+            'unset': sorted(name for name in os.environ
+                            if name not in ignored and name not in loaded)}
+        _SPACK_ENVIRONMENT_CACHE_ROOT.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=str(_SPACK_ENVIRONMENT_CACHE_ROOT),
+                                         delete=False) as cache_file:
+            json.dump(difference, cache_file, indent=2)
+        os.replace(cache_file.name, str(cache_path))
+    environment = dict(os.environ)
+    environment.update(difference['set'])
+    for name in difference['unset']:
+        environment.pop(name, None)
+    _SPACK_ENVIRONMENTS[key] = environment
+    return environment
+
+
+def flash_build_key(setup_dir: pathlib.Path, setup_command: str,
+                    transpiled_paths: t.Iterable[pathlib.Path] = (),
+                    env: t.Optional[t.Mapping[str, str]] = None) -> str:
+    """Compute content-addressed key of a FLASH build.
+
+    The key covers: commit of the repository containing FLASH, full setup command, FLASH site,
+    host, build-related environment variables and hashes of transpiled source files. Transpiled
+    files are the ones given explicitly and the ones for which a ".bak" backup exists.
+    Location of setup_dir is not part of the key, so that checkouts of the same commit in
+    different places (e.g. git worktrees) share builds.
+    Environment variables are taken from env if given, otherwise from the current environment.
+    """
+    commit = subprocess.run(
+        'git rev-parse HEAD', stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, shell=True,
+        cwd=str(setup_dir)).stdout.decode().strip()
+    setup_dir = setup_dir.resolve()
+    transpiled_paths = set(pathlib.Path(_).resolve() for _ in transpiled_paths)
+    for backup_path in setup_dir.joinpath('source').glob('**/*.bak'):
+        transpiled_paths.add(backup_path.with_suffix('').resolve())
+    key_data = {
+        'commit': commit,
+        'setup_command': setup_command,
+        'site': FLASH_SITE,
+        'host': platform.node(),
+        'environment': {name: (os.environ if env is None else env).get(name)
+                        for name in BUILD_ENVIRONMENT_VARIABLES},
+        'transpiled': {str(path.relative_to(setup_dir)): _hash_file(path)
+                       for path in sorted(transpiled_paths) if path.is_file()}}
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def flash_build_lock(build_key: str):
+    """Hold an exclusive inter-process lock on a build key, so that identical builds happen once.
+
+    Whoever waited for the lock should try to restore the build from the cache first.
+    """
+    _BUILD_CACHE_ROOT.mkdir(parents=True, exist_ok=True)
+    with _BUILD_CACHE_ROOT.joinpath(build_key + '.lock').open('w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _flash_build_signature(build_key: str, build_dir: pathlib.Path) -> t.Optional[str]:
+    """Build key with modification time and size of the executable, if build_dir has one."""
+    try:
+        stat = build_dir.joinpath('flash4').stat()
+    except FileNotFoundError:
+        return None
+    return '{} {} {}'.format(build_key, stat.st_mtime_ns, stat.st_size)
+
+
+def _mark_flash_build(build_key: str, build_dir: pathlib.Path) -> None:
+    signature = _flash_build_signature(build_key, build_dir)
+    if signature is not None:
+        build_dir.joinpath(_BUILD_KEY_FILENAME).write_text(signature)
+
+
+def restore_flash_build(build_key: str, build_dir: pathlib.Path) -> bool:
+    """Replace build_dir with a cached build of the same key, if there is one.
+
+    Nothing is copied if build_dir already holds that build, i.e. if it was restored or stored
+    under the same key and its executable was not rebuilt since.
+    Symbolic links that pointed into the setup directory of the cached build are redirected
+    into the setup directory of build_dir, and keep their modification times.
+    """
+    try:
+        marker = build_dir.joinpath(_BUILD_KEY_FILENAME).read_text()
+    except FileNotFoundError:
+        marker = None
+    cached_dir = _BUILD_CACHE_ROOT.joinpath(build_key)
+    if marker is not None and marker == _flash_build_signature(build_key, build_dir):
+        if cached_dir.is_dir():
+            os.utime(str(cached_dir))
+        _LOG.warning('cached build %s is already in "%s"', build_key, build_dir)
+        return True
+    if not cached_dir.is_dir():
+        return False
+    os.utime(str(cached_dir))
+    if build_dir.is_dir():
+        shutil.rmtree(str(build_dir))
+    shutil.copytree(str(cached_dir.joinpath('objdir')), str(build_dir), symlinks=True)
+    with cached_dir.joinpath('origin').open() as origin_file:
+        origin = origin_file.read()
+    setup_dir = str(build_dir.parent.resolve())
+    if origin != setup_dir:
+        for entry in build_dir.iterdir():
+            if not entry.is_symlink():
+                continue
+            target = os.readlink(str(entry))
+            if target.startswith(origin + os.sep):
+                stat = entry.lstat()
+                entry.unlink()
+                entry.symlink_to(setup_dir + target[len(origin):])
+                # keep the link older than the executable, so that it isn't taken for an output
+                os.utime(str(entry), ns=(stat.st_atime_ns, stat.st_mtime_ns),
+                         follow_symlinks=False)
+    _mark_flash_build(build_key, build_dir)
+    _LOG.warning('restored cached build %s into "%s"', build_key, build_dir)
+    return True
+
+
+def store_flash_build(build_key: str, build_dir: pathlib.Path,
+                      max_size: int = BUILD_CACHE_MAX_SIZE) -> None:
+    """Put a copy of build_dir into the build cache under a given key.
+
+    Afterwards, least recently used builds are evicted until the cache fits within max_size bytes,
+    see evict_flash_builds().
+    """
+    _mark_flash_build(build_key, build_dir)
+    cached_dir = _BUILD_CACHE_ROOT.joinpath(build_key)
+    if cached_dir.is_dir():
+        return
+    _BUILD_CACHE_ROOT.mkdir(parents=True, exist_ok=True)
+    partial_dir = pathlib.Path(tempfile.mkdtemp(suffix='.partial', dir=str(_BUILD_CACHE_ROOT)))
+    shutil.copytree(str(build_dir), str(partial_dir.joinpath('objdir')), symlinks=True)
+    with partial_dir.joinpath('origin').open('w') as origin_file:
+        origin_file.write(str(build_dir.parent.resolve()))
+    try:
+        partial_dir.rename(cached_dir)
+    except OSError:
+        shutil.rmtree(str(partial_dir))  # the same build was stored concurrently
+        return
+    _LOG.warning('stored build of "%s" in cache as %s', build_dir, build_key)
+    evict_flash_builds(max_size)
+
+
+def _directory_size(path: pathlib.Path) -> int:
+    size = 0
+    for root, _, files in os.walk(str(path)):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+    return size
+
+
+def evict_flash_builds(max_size: int = BUILD_CACHE_MAX_SIZE) -> None:
+    """Remove least recently used builds until the build cache fits within max_size bytes.
+
+    A build is used when it is stored or restored. Builds whose key is locked by someone,
+    see flash_build_lock(), are not removed.
+    """
+    entries = []
+    for cached_dir in _BUILD_CACHE_ROOT.glob('*'):
+        if not cached_dir.is_dir() or cached_dir.suffix == '.partial':
+            continue
+        try:
+            entries.append((cached_dir.stat().st_mtime, _directory_size(cached_dir), cached_dir))
+        except FileNotFoundError:
+            continue
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, cached_dir in sorted(entries, key=lambda _: _[0]):
+        if total_size <= max_size:
+            break
+        with _BUILD_CACHE_ROOT.joinpath(cached_dir.name + '.lock').open('w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                if cached_dir.is_dir():
+                    shutil.rmtree(str(cached_dir))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        total_size -= size
+        _LOG.warning('evicted cached build %s', cached_dir.name)
@@ -0,0 +1,114 @@
+"""Utility functions to compare numerical outputs (checkpoint and plot files) of FLASH runs."""
+
+import concurrent.futures
+import logging
+import os
+import pathlib
+import typing as t
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+_LOG = logging.getLogger(__name__)
+
+OUTPUT_PATTERNS = ('*_hdf5_chk_*', '*_hdf5_plt_cnt_*')
+
+CHUNK_BYTES = 64 * 1024 ** 2
+
+
+def find_outputs(directory: pathlib.Path) -> t.List[pathlib.Path]:
+    """Find FLASH checkpoint and plot files in a directory."""
+    return sorted(path for pattern in OUTPUT_PATTERNS for path in directory.glob(pattern)
+                  if path.is_file())
+
+
+def _numeric_datasets(path: pathlib.Path) -> t.Dict[str, t.Tuple[t.Tuple[int, ...], int]]:
+    datasets = {}
+
+    def visit(name, item):
+        if isinstance(item, h5py.Dataset) and item.dtype.kind in 'iuf' and item.shape:
+            datasets[name] = (item.shape, item.dtype.itemsize)
+
+    with h5py.File(str(path), 'r') as output_file:
+        output_file.visititems(visit)
+    return datasets
+
+
+def _compare_chunk(path: pathlib.Path, reference_path: pathlib.Path, dataset: str,
+                   start: int, stop: int, rtol: float, atol: float) -> dict:
+    """Compare rows start:stop of a dataset (i.e. blocks, for FLASH unknowns) in two files."""
+    with h5py.File(str(path), 'r') as output_file, \
+            h5py.File(str(reference_path), 'r') as reference_file:
+        values = output_file[dataset][start:stop].astype(np.float64)
+        reference = reference_file[dataset][start:stop].astype(np.float64)
+    equal = (values == reference) | (np.isnan(values) & np.isnan(reference))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        abs_diff = np.abs(values - reference)
+        rel_diff = np.where(reference != 0, abs_diff / np.abs(reference), abs_diff)
+        mismatched = ~(equal | np.isfinite(reference)
+                       & (abs_diff <= atol + rtol * np.abs(reference)))
+    for diff in (abs_diff, rel_diff):
+        diff[mismatched & ~np.isfinite(diff)] = np.inf  # e.g. NaN, or finite vs infinite
+        diff[equal] = 0  # e.g. equal infinities
+    mismatched_rows = np.nonzero(mismatched.reshape(mismatched.shape[0], -1).any(axis=1))[0]
+    return {
+        'dataset': dataset, 'max_abs_diff': float(abs_diff.max()) if abs_diff.size else 0.0,
+        'max_rel_diff': float(rel_diff.max()) if rel_diff.size else 0.0,
+        'mismatched': int(mismatched.sum()),
+        'first_mismatched_block': int(start + mismatched_rows[0]) if mismatched_rows.size else None}
+
+
+def compare_outputs(path: pathlib.Path, reference_path: pathlib.Path, rtol: float = 1e-12,
+                    atol: float = 0.0, workers: int = None) -> t.List[dict]:
+    """Compare all numeric datasets of two FLASH HDF5 output files, variable by variable.
+
+    Datasets are read in chunks of whole blocks, roughly CHUNK_BYTES at a time, by a pool of
+    worker processes, so that memory use stays bounded regardless of the file size.
+    Values a and reference b match if a == b (including infinities), |a - b| <= atol + rtol * |b|,
+    or both are NaN. By default, there are as many workers as cores this process may use.
+
+    Return one result per dataset, with maximum absolute and relative differences, number of
+    mismatched values and the first mismatched block (if any). Datasets present in only one of
+    the files, or differing in shape, are reported as mismatched.
+    """
+    assert h5py is not None, 'h5py is needed to compare FLASH outputs'
+    if workers is None:
+        workers = len(os.sched_getaffinity(0))
+    datasets = _numeric_datasets(path)
+    reference_datasets = _numeric_datasets(reference_path)
+    results = {}
+    for dataset in sorted(set(datasets) ^ set(reference_datasets)):
+        results[dataset] = {'dataset': dataset, 'error': 'present in only one of the files'}
+    chunks = []
+    for dataset in sorted(set(datasets) & set(reference_datasets)):
+        shape, itemsize = datasets[dataset]
+        if shape != reference_datasets[dataset][0]:
+            results[dataset] = {'dataset': dataset, 'error': 'shape {} differs from {}'.format(
+                shape, reference_datasets[dataset][0])}
+            continue
+        row_bytes = max(itemsize * int(np.prod(shape[1:])), 1)
+        rows_per_chunk = max(CHUNK_BYTES // row_bytes, 1)
+        chunks += [(dataset, start, min(start + rows_per_chunk, shape[0]))
+                   for start in range(0, shape[0], rows_per_chunk)]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_compare_chunk, path, reference_path, dataset, start, stop,
+                                   rtol, atol) for dataset, start, stop in chunks]
+        for future in futures:
+            chunk_result = future.result()
+            result = results.setdefault(chunk_result['dataset'], {
+                'dataset': chunk_result['dataset'], 'max_abs_diff': 0.0, 'max_rel_diff': 0.0,
+                'mismatched': 0, 'first_mismatched_block': None})
+            result['max_abs_diff'] = max(result['max_abs_diff'], chunk_result['max_abs_diff'])
+            result['max_rel_diff'] = max(result['max_rel_diff'], chunk_result['max_rel_diff'])
+            result['mismatched'] += chunk_result['mismatched']
+            if result['first_mismatched_block'] is None:
+                result['first_mismatched_block'] = chunk_result['first_mismatched_block']
+    return [results[dataset] for dataset in sorted(results)]
+
+
+def mismatches(results: t.List[dict]) -> t.List[dict]:
+    return [result for result in results if 'error' in result or result['mismatched']]
@@ -1,21 +1,37 @@
 """Utility functions to assist profiling FLASH across code versions and problem configurations."""
 
-import datetime
+import argparse
+import array
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
 import logging
-# import math
+import math
+import os
 import pathlib
+import pickle
+import queue
+import shutil
+import statistics
+import tempfile
+import time
 import typing as t
+import xml.etree.ElementTree as ET
 
 import git
 
-from common import HPCRUN_EXE, HPCSTRUCT_EXE, HPCPROF_EXE, FLASH_SITE, profile_path, profile_db_path, _run_and_check
+from common import HPCRUN_EXE, HPCSTRUCT_EXE, HPCPROF_EXE, HPCPROF_MPI_EXE, FLASH_SITE, \
+    FORTRAN_SUFFIXES, logs_path, profile_path, profile_db_path, flash_build_key, \
+    flash_build_lock, restore_flash_build, store_flash_build, timed_phase, run_on_cores, \
+    flash_dimensionality, spack_environment, _STRUCT_CACHE_ROOT, _hash_file, _run_and_check
 
 _HERE = pathlib.Path(__file__).parent.resolve()
 
 _LOG = logging.getLogger(__name__)
 
-_JUST_RAN = None
-
 
 def make_sfocu(flash_dir: pathlib.Path):
     sfocu_dir = flash_dir.joinpath('tools', 'sfocu')
@@ -25,34 +41,47 @@ def make_sfocu(flash_dir: pathlib.Path):
                    test_name='sfocu', phase_name='make')
 
 
-def setup_flash(experiment, objdir: str, setup_dir, *,
-                test_name: str, phase_name: str = 'setup'):
+def _setup_command(experiment, objdir: str) -> str:
     setup_command = './setup -site {} {}'.format(FLASH_SITE, experiment)
     if objdir != 'object':
         setup_command += ' -objdir={}'.format(objdir)
-    _run_and_check(setup_command, setup_dir,
-                   test_name=test_name, phase_name=phase_name)
+    return setup_command
 
 
-def make_flash(build_dir, *,
-               test_name: str, phase_name: str = 'make'):
-    _run_and_check('make', build_dir,
-                   test_name=test_name, phase_name=phase_name)
+def setup_flash(experiment, objdir: str, setup_dir, env=None, *,
+                test_name: str, phase_name: str = 'setup', live_output: bool = False):
+    setup_command = _setup_command(experiment, objdir)
+    _run_and_check(setup_command, setup_dir, env,
+                   test_name=test_name, phase_name=phase_name, live_output=live_output)
 
 
-def clean_flash(build_dir, *,
-                test_name: str, phase_name: str = 'clean'):
-    _run_and_check('make clean', build_dir,
-                   test_name=test_name, phase_name=phase_name)
+def make_flash(build_dir, env=None, *,
+               test_name: str, phase_name: str = 'make', live_output: bool = False):
+    _run_and_check('make', build_dir, env,
+                   test_name=test_name, phase_name=phase_name, live_output=live_output)
 
 
-def hpctoolkit_profile(executable: pathlib.Path, results_path: pathlib.Path, sample_size: int,
-                       events: t.Dict[str, t.Union[bool, int]] = None, mpi_proc: int = 0, *,
-                       test_name: str, phase_name: str = 'profile'):
-    assert isinstance(executable, pathlib.Path), type(executable)
-    if events is None:
-        events = {}
-    results_path.parent.mkdir(exist_ok=True)
+def clean_flash(build_dir, env=None, *,
+                test_name: str, phase_name: str = 'clean', live_output: bool = False):
+    _run_and_check('make clean', build_dir, env,
+                   test_name=test_name, phase_name=phase_name, live_output=live_output)
+
+
+INTERFERENCE_THRESHOLD = 0.1
+
+# two-sided 95% critical values of Student's t distribution, by sample size
+_T_95 = {2: 12.706, 3: 4.303, 4: 3.182, 5: 2.776, 6: 2.571, 7: 2.447, 8: 2.365, 9: 2.306,
+         10: 2.262, 12: 2.201, 15: 2.145, 20: 2.093, 25: 2.064, 30: 2.045, 40: 2.023, 60: 2.001}
+
+
+def _t_95(sample_size: float) -> float:
+    if sample_size > max(_T_95):
+        return 1.960
+    return _T_95[max(_ for _ in _T_95 if _ <= max(sample_size, 2))]
+
+
+def _hpcrun_command(executable: pathlib.Path, results_path: pathlib.Path,
+                    events: t.Dict[str, t.Union[bool, int]], mpi_proc: int) -> str:
     events_options = [
         ' -e {}{}'.format(event, '' if rate is True else '@{}'.format(
             rate if isinstance(rate, int) else 'f{}'.format(round(1 / rate))))
@@ -61,65 +90,857 @@ def hpctoolkit_profile(executable: pathlib.Path, results_path: pathlib.Path, sam
         HPCRUN_EXE, ''.join(events_options), results_path, executable)
     if mpi_proc > 0:
         hpcrun_command = 'mpirun -np {} {}'.format(mpi_proc, hpcrun_command)
-    _LOG.warning('%s.%s: running the experiment %i times...', test_name, phase_name, sample_size)
-    for i in range(sample_size):
-        _run_and_check(hpcrun_command, executable.parent,
-                       test_name=test_name, phase_name=phase_name)
+    return hpcrun_command
+
+
+def sampling_precision(wall_times: t.Sequence[float], criterion: str = 'ci') -> float:
+    """Relative precision of mean wall time of samples, the lower the better.
+
+    Criterion "ci" is the half-width of 95% confidence interval of the mean divided by the mean,
+    and "cv" is the coefficient of variation.
+    """
+    mean = statistics.mean(wall_times)
+    stdev = statistics.stdev(wall_times)
+    if criterion == 'cv':
+        return stdev / mean
+    assert criterion == 'ci', criterion
+    return _t_95(len(wall_times)) * stdev / math.sqrt(len(wall_times)) / mean
+
+
+def hpctoolkit_profile(executable: pathlib.Path, results_path: pathlib.Path, sample_size: int,
+                       events: t.Dict[str, t.Union[bool, int]] = None, mpi_proc: int = 0,
+                       concurrency: int = 1, adaptive_target: float = None,
+                       adaptive_criterion: str = 'ci', min_sample_size: int = 3,
+                       cores: t.Sequence[int] = None, env: t.Dict[str, str] = None, *,
+                       test_name: str, phase_name: str = 'profile'):
+    """Run the executable sample_size times under hpcrun.
+
+    If cores are given, only they are used, and the executable is run in a private working
+    directory, so that it can be profiled alongside other runs of the same build.
+    If env is given, the executable is run in that environment, see spack_environment().
+
+    If concurrency is greater than 1, see _hpctoolkit_profile_concurrently().
+
+    Otherwise, if adaptive_target is given, sample_size is the maximum and sampling stops early
+    once at least min_sample_size samples were taken and sampling_precision() of their wall times
+    drops to adaptive_target or below.
+
+    Number of samples taken and their wall times are written to "..._sampling.json" file
+    next to results_path.
+    """
+    assert isinstance(executable, pathlib.Path), type(executable)
+    if events is None:
+        events = {}
+    results_path.parent.mkdir(exist_ok=True)
+    report = None
+    if concurrency > 1 and sample_size > 1:
+        if adaptive_target is not None:
+            _LOG.warning('%s.%s: adaptive sampling is not supported for concurrent samples',
+                         test_name, phase_name)
+        report = _hpctoolkit_profile_concurrently(
+            executable, results_path, sample_size, events, mpi_proc, concurrency, cores, env,
+            test_name=test_name, phase_name=phase_name)
+    if report is not None:
+        wall_times = report['wall_times']
+    else:
+        wall_times = []
+        hpcrun_command = _hpcrun_command(executable, results_path, events, mpi_proc)
+        run_dir = executable.parent
+        if cores is not None:
+            hpcrun_command = 'taskset -c {} {}'.format(
+                ','.join(str(core) for core in cores), hpcrun_command)
+            run_dir = results_path.with_name(results_path.name + '_run')
+            _prepare_run_dir(executable, run_dir)
+        _LOG.warning('%s.%s: running the experiment %s%i times...', test_name, phase_name,
+                     '' if adaptive_target is None else 'at most ', sample_size)
+        for i in range(sample_size):
+            start = time.perf_counter()
+            _run_and_check(hpcrun_command, run_dir, env,
+                           test_name=test_name, phase_name=phase_name, monitor=True)
+            wall_times.append(time.perf_counter() - start)
+            if adaptive_target is not None and len(wall_times) >= max(min_sample_size, 2) \
+                    and sampling_precision(wall_times, adaptive_criterion) <= adaptive_target:
+                _LOG.warning('%s.%s: wall time converged after %i samples',
+                             test_name, phase_name, len(wall_times))
+                break
+    precision = None
+    if len(wall_times) > 1:
+        precision = sampling_precision(wall_times, adaptive_criterion)
+    sampling = {'sample_size': len(wall_times), 'max_sample_size': sample_size,
+                'wall_times': wall_times, 'adaptive_target': adaptive_target,
+                'adaptive_criterion': adaptive_criterion, 'precision': precision}
+    with results_path.with_name(results_path.name + '_sampling.json').open('w') as sampling_file:
+        json.dump(sampling, sampling_file, indent=2)
+    return report
+
+
+def _core_sets(cores_per_sample: int, count: int,
+               cores: t.Sequence[int] = None) -> t.List[t.List[int]]:
+    cores = sorted(os.sched_getaffinity(0) if cores is None else cores)
+    count = min(count, len(cores) // cores_per_sample)
+    return [cores[i * cores_per_sample:(i + 1) * cores_per_sample] for i in range(count)]
+
+
+def _prepare_run_dir(executable: pathlib.Path, run_dir: pathlib.Path):
+    """Populate run_dir with symbolic links to the build, but not to outputs of earlier runs.
+
+    Outputs are recognized as files modified after the executable was built.
+    """
+    run_dir.mkdir(parents=True, exist_ok=True)
+    built = executable.stat().st_mtime
+    for entry in executable.parent.iterdir():
+        if entry.name != 'flash.par' and entry.lstat().st_mtime > built:
+            continue
+        link = run_dir.joinpath(entry.name)
+        if not link.is_symlink() and not link.exists():
+            link.symlink_to(entry)
+
+
+def _hpctoolkit_profile_concurrently(
+        executable: pathlib.Path, results_path: pathlib.Path, sample_size: int,
+        events: t.Dict[str, t.Union[bool, int]], mpi_proc: int, concurrency: int,
+        cores: t.Sequence[int] = None, env: t.Dict[str, str] = None, *,
+        test_name: str, phase_name: str) -> t.Optional[dict]:
+    """Run independent hpcrun samples concurrently, each pinned to a disjoint set of cores.
+
+    Each concurrent slot has its own working directory (so that FLASH outputs don't clash)
+    and its own measurement subdirectory, which are merged into results_path at the end.
+    The first sample is run alone, and serves as reference to detect interference between
+    concurrent samples, e.g. due to memory bandwidth contention.
+
+    Return a report with wall times of all samples, reference and median concurrent wall times,
+    relative slowdown and whether it exceeds INTERFERENCE_THRESHOLD -- or None if there are
+    not enough cores to run samples concurrently.
+    """
+    core_sets = _core_sets(max(mpi_proc, 1), concurrency, cores)
+    if len(core_sets) < 2:
+        _LOG.warning('%s.%s: not enough cores to run samples concurrently', test_name, phase_name)
+        return None
+    slots = []
+    for i, cores in enumerate(core_sets):
+        run_dir = results_path.with_name('{}_run_{}'.format(results_path.name, i))
+        _prepare_run_dir(executable, run_dir)
+        measurements_path = results_path.joinpath('slot_{}'.format(i))
+        hpcrun_command = 'taskset -c {} {}'.format(
+            ','.join(str(core) for core in cores),
+            _hpcrun_command(executable, measurements_path, events, mpi_proc))
+        slots.append((i, run_dir, measurements_path, hpcrun_command))
+
+    def run_sample(slot) -> float:
+        i, run_dir, _, hpcrun_command = slot
+        start = time.perf_counter()
+        _run_and_check(hpcrun_command, run_dir, env, test_name=test_name,
+                       phase_name='{}.{}'.format(phase_name, i), monitor=True)
+        return time.perf_counter() - start
+
+    free_slots = queue.Queue()
+    for slot in slots:
+        free_slots.put(slot)
+
+    def run_sample_in_free_slot(_) -> float:
+        slot = free_slots.get()
+        try:
+            return run_sample(slot)
+        finally:
+            free_slots.put(slot)
+
+    _LOG.warning('%s.%s: running the experiment %i times, up to %i at once...',
+                 test_name, phase_name, sample_size, len(slots))
+    reference_time = run_sample(slots[0])
+    with concurrent.futures.ThreadPoolExecutor(len(slots)) as executor:
+        concurrent_times = list(executor.map(run_sample_in_free_slot, range(1, sample_size)))
+
+    results_path.mkdir(parents=True, exist_ok=True)
+    for _, _, measurements_path, _ in slots:
+        if not measurements_path.is_dir():
+            continue
+        for measurement in measurements_path.iterdir():
+            measurement.rename(results_path.joinpath(measurement.name))
+        measurements_path.rmdir()
+
+    concurrent_time = statistics.median(concurrent_times)
+    slowdown = concurrent_time / reference_time - 1
+    report = {'concurrency': len(slots), 'wall_times': [reference_time] + concurrent_times,
+              'reference_time': reference_time,
+              'concurrent_median_time': concurrent_time, 'slowdown': slowdown,
+              'interference': slowdown > INTERFERENCE_THRESHOLD}
+    if report['interference']:
+        _LOG.warning('%s.%s: concurrent samples were %.0f%% slower than an isolated one,'
+                     ' most likely due to contention for shared resources (e.g. memory bandwidth)'
+                     ' -- consider lower concurrency', test_name, phase_name, 100 * slowdown)
+    return report
+
+
+def hpctoolkit_struct(executable: pathlib.Path, struct_path: pathlib.Path,
+                      source_path: pathlib.Path, env: t.Dict[str, str] = None, *,
+                      test_name: str, phase_name: str = 'hpcstruct'):
+    """Run hpcstruct on the executable, unless the same executable was analysed before.
+
+    Struct files are cached by content hash of the executable (and the source path).
+    """
+    struct_key = hashlib.sha256('{}\0{}'.format(
+        _hash_file(executable), source_path.resolve()).encode()).hexdigest()
+    cached_struct_path = _STRUCT_CACHE_ROOT.joinpath(struct_key + '.hpcstruct')
+    struct_path.parent.mkdir(parents=True, exist_ok=True)
+    if cached_struct_path.is_file():
+        _LOG.warning('%s.%s: using cached struct file "%s"', test_name, phase_name,
+                     cached_struct_path)
+        shutil.copyfile(str(cached_struct_path), str(struct_path))
+        return
+    hpcstruct_command = '{} -I "{}" --verbose -o {} {}'.format(
+        HPCSTRUCT_EXE, source_path.joinpath('*'), struct_path, executable)
+    _run_and_check(hpcstruct_command, source_path, env,
+                   test_name=test_name, phase_name=phase_name)
+    _STRUCT_CACHE_ROOT.mkdir(parents=True, exist_ok=True)
+    handle, partial_struct_path = tempfile.mkstemp(suffix='.partial', dir=str(_STRUCT_CACHE_ROOT))
+    os.close(handle)
+    shutil.copyfile(str(struct_path), partial_struct_path)
+    os.replace(partial_struct_path, str(cached_struct_path))
 
 
 def hpctoolkit_summarize(executable: pathlib.Path, results_path: pathlib.Path,
-                         source_path: pathlib.Path, *,
+                         source_path: pathlib.Path, hpcprof_ranks: int = 0,
+                         env: t.Dict[str, str] = None, *,
                          test_name: str, phase_name: str = 'summarize'):
+    """Create profile database from measurements in results_path.
+
+    If hpcprof_ranks is positive, parallel hpcprof-mpi with that many MPI ranks is used.
+    """
     struct_path = results_path.joinpath(executable.name + '.hpcstruct')
-    hpcstruct_command = '{} -I "{}" --verbose -o {} {}'.format(
-        HPCSTRUCT_EXE, source_path.joinpath('*'), struct_path, executable)
-    _run_and_check(hpcstruct_command, source_path,
-                   test_name=test_name, phase_name='{}.hpcstruct'.format(phase_name))
+    hpctoolkit_struct(executable, struct_path, source_path, env,
+                      test_name=test_name, phase_name='{}.hpcstruct'.format(phase_name))
     hpcprof_command = '{} -I "{}" --replace-path "{}=." {} -S {} -M stats -o {}'.format(
-        HPCPROF_EXE, source_path.joinpath('+'), source_path, results_path, struct_path,
-        profile_db_path(test_name=test_name))
-    _run_and_check(hpcprof_command, source_path,
+        HPCPROF_EXE if hpcprof_ranks <= 0 else HPCPROF_MPI_EXE, source_path.joinpath('+'),
+        source_path, results_path, struct_path, profile_db_path(test_name=test_name))
+    if hpcprof_ranks > 0:
+        hpcprof_command = 'mpirun -np {} {}'.format(hpcprof_ranks, hpcprof_command)
+    _run_and_check(hpcprof_command, source_path, env,
                    test_name=test_name, phase_name='{}.hpcprof'.format(phase_name))
 
 
 def profile_flash(app_name: str, executable: pathlib.Path, source_path: pathlib.Path,
-                  sample_size: int, events=None, mpi_proc=0, *,
-                  test_name: str):
+                  sample_size: int, events=None, mpi_proc=0, concurrency=1, adaptive_target=None,
+                  adaptive_criterion='ci', min_sample_size=3, hpcprof_ranks=0, cores=None,
+                  env=None, *, test_name: str):
     results_path = profile_path(test_name=test_name)
-    hpctoolkit_profile(executable, results_path, sample_size, events, mpi_proc, test_name=test_name)
-    hpctoolkit_summarize(executable, results_path, source_path, test_name=test_name)
+    hpctoolkit_profile(executable, results_path, sample_size, events, mpi_proc, concurrency,
+                       adaptive_target, adaptive_criterion, min_sample_size, cores, env,
+                       test_name=test_name)
+    hpctoolkit_summarize(executable, results_path, source_path, hpcprof_ranks, env,
+                         test_name=test_name)
+
+
+def _setup_dir(app_name: str, app_dir: pathlib.Path) -> pathlib.Path:
+    return {
+        'flash-subset': app_dir.joinpath('FLASH4.4')
+        }.get(app_name, app_dir)
+
+
+def build_flash(experiment, objdir: str, setup_dir: pathlib.Path, rebuild: bool = None,
+                env: t.Dict[str, str] = None, *, test_name: str,
+                live_output: bool = False) -> pathlib.Path:
+    """Set up and make FLASH, or restore it from the build cache, and return the executable.
+
+    If rebuild is None, a matching build is restored from the build cache if available.
+    If rebuild is True, FLASH is always built. If rebuild is False, the existing objdir is used.
+    If live_output is True, output of setup and make is also echoed, see _run_and_check().
+    """
+    build_dir = setup_dir.joinpath(objdir)
+    if rebuild is not False:
+        build_key = flash_build_key(setup_dir, _setup_command(experiment, objdir), env=env)
+        with timed_phase(test_name=test_name, phase_name='build'), flash_build_lock(build_key):
+            if rebuild or not restore_flash_build(build_key, build_dir):
+                setup_flash(experiment, objdir, setup_dir, env,
+                            test_name=test_name, live_output=live_output)
+                make_flash(build_dir, env,
+                           test_name=test_name, live_output=live_output)
+                store_flash_build(build_key, build_dir)
+    return build_dir.joinpath('flash4')
 
 
 def profile_experiment(app_name: str, experiment: str, branch: str, objdir: str,
                        sample_size: int, *,
                        rebuild: bool = None, clean: bool = False,
-                       test_name: str, **kwargs):
-    global _JUST_RAN
-    if rebuild is None and _JUST_RAN \
-            and datetime.datetime.now() - _JUST_RAN[0] < datetime.timedelta(seconds=10) \
-            and _JUST_RAN[1:] == (app_name, experiment, branch):
-        _JUST_RAN = None
-        rebuild = False
+                       test_name: str, live_output: bool = False, **kwargs):
+    """Build FLASH and profile it.
+
+    If rebuild is None, a matching build is restored from the build cache if available.
+    If rebuild is True, FLASH is always built. If rebuild is False, the existing objdir is used.
+    If live_output is True, output of setup, make and clean is also echoed.
+    Spack packages for the host are loaded according to ENVIRONMENT, see spack_environment().
+    """
     app_dir = pathlib.Path(_HERE, app_name)
-    setup_dir = {
-        'flash-subset': app_dir.joinpath('FLASH4.4')
-        }.get(app_name, app_dir)
+    setup_dir = _setup_dir(app_name, app_dir)
     repo = git.Repo(str(app_dir))
     assert not repo.is_dirty(untracked_files=True), repo
     if str(repo.active_branch) != branch:
         _LOG.warning('%s: checking out %s', test_name, branch)
         repo.git.checkout(branch)
-        rebuild = True
+        rebuild = rebuild or None
     build_dir = setup_dir.joinpath(objdir)
-    executable = build_dir.joinpath('flash4')
-    if rebuild is not False:
-        setup_flash(experiment, objdir, setup_dir,
-                    test_name=test_name)
-        make_flash(build_dir,
-                   test_name=test_name)
-    profile_flash(app_name, executable, app_dir, sample_size, **kwargs,
+    env = spack_environment(flash_dimensionality(experiment))
+    executable = build_flash(experiment, objdir, setup_dir, rebuild, env, test_name=test_name,
+                             live_output=live_output)
+    profile_flash(app_name, executable, app_dir, sample_size, **kwargs, env=env,
                   test_name=test_name)
     if clean:
-        clean_flash(build_dir,
-                    test_name=test_name)
-    _JUST_RAN = (datetime.datetime.now(), app_name, experiment, branch)
+        clean_flash(build_dir, env,
+                    test_name=test_name, live_output=live_output)
+
+
+def branch_worktree(app_name: str, branch: str) -> pathlib.Path:
+    """Get a git worktree of the application with the branch checked out (as detached HEAD).
+
+    Worktrees are kept in "worktrees" folder, one per application and branch, so that each branch
+    keeps its own objdirs and switching between branches does not force rebuilds.
+    """
+    app_dir = pathlib.Path(_HERE, app_name)
+    worktree_dir = pathlib.Path(
+        _HERE, 'worktrees', '{}_{}'.format(app_name, branch.replace('/', '_')))
+    repo = git.Repo(str(app_dir))
+    if worktree_dir.is_dir():
+        worktree_repo = git.Repo(str(worktree_dir))
+        if worktree_repo.head.commit != repo.commit(branch):
+            worktree_repo.git.checkout(repo.commit(branch).hexsha, detach=True)
+    else:
+        worktree_dir.parent.mkdir(parents=True, exist_ok=True)
+        repo.git.worktree('add', '--detach', str(worktree_dir), branch)
+    return worktree_dir
+
+
+def schedule_experiments(app_name: str, branch_nicknames: t.Dict[str, str],
+                         problems: t.Sequence[t.Tuple[str, str]], mpi_processes: t.Sequence[int],
+                         objdir: str, sample_size: int, *,
+                         test_name_template: str, build_workers: int = None,
+                         cores: t.Sequence[int] = None, rebuild: bool = None,
+                         **kwargs) -> t.Dict[t.Tuple[str, str, str, int], str]:
+    """Build and profile the whole experiment matrix: branches x problems x MPI process counts.
+
+    Each branch gets its own worktree, see branch_worktree(), and each problem its own objdir
+    named "{objdir}_{index of problem}". Up to build_workers builds run at once. Then profiling
+    runs are scheduled onto the available cores (by default all cores this process may use),
+    each pinned to max(mpi_proc, 1) cores of its own.
+
+    Test names are created from test_name_template, which may use {problem}, {index} (of problem),
+    {nickname} and {mpi_proc}, and must be unique. The same problem may be given many times,
+    with different options, in which case the template should use {index}.
+    Other keyword arguments are passed to profile_flash().
+
+    Return test names of all runs, by (branch, problem, options, mpi_proc).
+    """
+    test_names = {}
+    for (branch, nickname), (index, (problem, options)), mpi_proc in itertools.product(
+            branch_nicknames.items(), enumerate(problems), mpi_processes):
+        test_name = test_name_template.format(
+            problem=problem, index=index, nickname=nickname, mpi_proc=mpi_proc)
+        key = branch, problem, options, mpi_proc
+        assert key not in test_names, 'experiment {} is given more than once'.format(key)
+        assert test_name not in test_names.values(), \
+            'test name "{}" is not unique, see test_name_template'.format(test_name)
+        test_names[key] = test_name
+
+    worktrees = {branch: branch_worktree(app_name, branch) for branch in branch_nicknames}
+    envs = [spack_environment(flash_dimensionality(options)) for _, options in problems]
+    builds = {}
+    with concurrent.futures.ThreadPoolExecutor(build_workers) as executor:
+        for (branch, nickname), (index, (problem, options)) in itertools.product(
+                branch_nicknames.items(), enumerate(problems)):
+            builds[branch, index] = executor.submit(
+                build_flash, '{} {}'.format(problem, options), '{}_{}'.format(objdir, index),
+                _setup_dir(app_name, worktrees[branch]), rebuild, envs[index],
+                test_name='build_{}_{}_{}'.format(nickname, problem, index))
+    executables = {key: build.result() for key, build in builds.items()}
+
+    runs = []
+    for branch, (index, (problem, options)), mpi_proc in itertools.product(
+            branch_nicknames, enumerate(problems), mpi_processes):
+        test_name = test_names[branch, problem, options, mpi_proc]
+        runs.append((max(mpi_proc, 1), functools.partial(
+            profile_flash, app_name, executables[branch, index], worktrees[branch],
+            sample_size, mpi_proc=mpi_proc, **kwargs, env=envs[index], test_name=test_name)))
+    run_on_cores(runs, cores)
+    return test_names
+
+
+_EXPERIMENT_NODE_KINDS = {
+    'SecCallPathProfileData': 'root', 'PF': 'procedure', 'Pr': 'procedure', 'A': 'alien',
+    'L': 'loop', 'C': 'call site', 'S': 'statement'}
+
+
+def _parse_experiment_xml(path: pathlib.Path) -> dict:
+    """Parse HPCToolkit experiment.xml incrementally into a columnar table of calling context tree.
+
+    Each row is one node of the tree. Structural columns are: id, parent (row index, -1 for root),
+    depth, kind, procedure, file and line. Each metric is a separate column in "metrics" dict.
+    Metric values absent from the database are zeros.
+    """
+    metric_names = {}
+    procedures = {}
+    files = {}
+    columns = {'id': array.array('q'), 'parent': array.array('q'), 'depth': array.array('l'),
+               'kind': [], 'procedure': [], 'file': [], 'line': array.array('l')}
+    metrics = {}
+    stack = []  # row indices of open nodes
+    in_data = False
+    for event, element in ET.iterparse(str(path), events=('start', 'end')):
+        tag = element.tag
+        if event == 'end':
+            if tag in _EXPERIMENT_NODE_KINDS and in_data:
+                stack.pop()
+                if tag == 'SecCallPathProfileData':
+                    in_data = False
+            element.clear()
+            continue
+        if tag == 'Metric':
+            metric_names[element.get('i')] = element.get('n')
+        elif tag == 'Procedure':
+            procedures[element.get('i')] = element.get('n')
+        elif tag == 'File':
+            files[element.get('i')] = element.get('n')
+        elif tag == 'SecCallPathProfileData':
+            in_data = True
+        if tag in _EXPERIMENT_NODE_KINDS and in_data:
+            row = len(columns['kind'])
+            kind = _EXPERIMENT_NODE_KINDS[tag]
+            procedure = {'root': '<program root>', 'loop': '<loop>', 'call site': '<call site>',
+                         'statement': '<statement>'}.get(kind)
+            if procedure is None:
+                procedure = procedures.get(element.get('n'), element.get('n'))
+            columns['id'].append(int(element.get('i', 0)))
+            columns['parent'].append(stack[-1] if stack else -1)
+            columns['depth'].append(len(stack))
+            columns['kind'].append(kind)
+            columns['procedure'].append(procedure)
+            columns['file'].append(files.get(element.get('f')))
+            columns['line'].append(int(element.get('l', 0)))
+            for metric in metrics.values():
+                metric.append(0.0)
+            stack.append(row)
+        elif tag == 'M' and in_data:
+            name = metric_names.get(element.get('n'), element.get('n'))
+            if name not in metrics:
+                metrics[name] = array.array('d', [0.0] * len(columns['kind']))
+            metrics[name][stack[-1]] = float(element.get('v'))
+    columns['metrics'] = metrics
+    return columns
+
+
+# version of tables cached by load_experiment(), to be increased whenever their format changes
+_EXPERIMENT_CACHE_VERSION = 1
+
+
+def _write_experiment_cache(cache_path: pathlib.Path, cached: dict):
+    handle, partial_path = tempfile.mkstemp(suffix='.partial', dir=str(cache_path.parent))
+    with os.fdopen(handle, 'wb') as cache_file:
+        pickle.dump(cached, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(partial_path, str(cache_path))
+
+
+def load_experiment(path: pathlib.Path, use_cache: bool = True) -> dict:
+    """Load HPCToolkit experiment.xml as a columnar table, see _parse_experiment_xml().
+
+    Parsed table is cached in "experiment.pickle" next to the XML file. The cache is valid while
+    modification time and size of the XML are unchanged, or if its content hash is unchanged,
+    and only if it was created by the current version of the parser.
+    """
+    cache_path = path.with_suffix('.pickle')
+    stat = path.stat()
+    xml_hash = None
+    cached = None
+    if use_cache:
+        try:
+            with cache_path.open('rb') as cache_file:
+                cached = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+    if isinstance(cached, dict) and cached.get('version') == _EXPERIMENT_CACHE_VERSION:
+        if (cached['mtime'], cached['size']) == (stat.st_mtime, stat.st_size):
+            return cached['table']
+        xml_hash = _hash_file(path)
+        if cached['hash'] == xml_hash:
+            cached['mtime'] = stat.st_mtime
+            _write_experiment_cache(cache_path, cached)
+            return cached['table']
+    table = _parse_experiment_xml(path)
+    if use_cache:
+        if xml_hash is None:
+            xml_hash = _hash_file(path)
+        _write_experiment_cache(cache_path, {
+            'version': _EXPERIMENT_CACHE_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size,
+            'hash': xml_hash, 'table': table})
+    return table
+
+
+def experiment_dataframe(path: pathlib.Path, use_cache: bool = True):
+    """Load HPCToolkit experiment.xml as pandas DataFrame, with one column per metric."""
+    import pandas as pd
+    table = load_experiment(path, use_cache)
+    data = {name: column for name, column in table.items() if name != 'metrics'}
+    data.update(table['metrics'])
+    return pd.DataFrame(data)
+
+
+def _experiment_xml_path(path: pathlib.Path) -> pathlib.Path:
+    return path.joinpath('experiment.xml') if path.is_dir() else path
+
+
+def _procedure_paths(table: dict) -> t.List[t.Tuple[str, ...]]:
+    """Path of each node as procedure names of its procedure (or inlined code) ancestors."""
+    paths = []
+    for parent, kind, procedure in zip(table['parent'], table['kind'], table['procedure']):
+        path = paths[parent] if parent >= 0 else ()
+        if kind in ('procedure', 'alien'):
+            path += (procedure,)
+        paths.append(path)
+    return paths
+
+
+def _inclusive_by_procedure_path(table: dict, metric: str) -> t.Dict[t.Tuple[str, ...], float]:
+    """Sum of inclusive metric over procedure nodes, by path, see _procedure_paths()."""
+    values = collections.defaultdict(float)
+    column = table['metrics'].get(metric, ())
+    for kind, path, value in zip(table['kind'], _procedure_paths(table), column):
+        if kind in ('procedure', 'alien'):
+            values[path] += value
+    return values
+
+
+def hot_path(table: dict, metric: str = 'CPUTIME (usec):Sum (I)',
+             threshold: float = 0.5) -> t.List[int]:
+    """Find row indices of nodes on the hot path of calling context tree, starting at root.
+
+    The path follows the child with the largest inclusive metric as long as that child accounts
+    for at least threshold of its parent.
+    """
+    children = collections.defaultdict(list)
+    for row, parent in enumerate(table['parent']):
+        children[parent].append(row)
+    column = table['metrics'][metric]
+    path = list(children[-1][:1])
+    while path and children[path[-1]]:
+        hottest = max(children[path[-1]], key=lambda row: column[row])
+        if column[hottest] < threshold * column[path[-1]]:
+            break
+        path.append(hottest)
+    return path
+
+
+def _efficiency_slope(ranks: t.Sequence[int], efficiencies: t.Sequence[float]) -> float:
+    """Least-squares slope of efficiency against log2 of number of ranks."""
+    xs = [math.log2(_) for _ in ranks]
+    x_mean, y_mean = statistics.mean(xs), statistics.mean(efficiencies)
+    variance = sum((x - x_mean) ** 2 for x in xs)
+    if not variance:
+        return 0.0
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, efficiencies)) / variance
+
+
+def strong_scaling(databases: t.Mapping[int, pathlib.Path], metric: str = 'CPUTIME (usec)',
+                   hot_path_threshold: float = 0.5, min_share: float = 0.05) -> dict:
+    """Compute speedup and parallel efficiency over a sweep of numbers of MPI processes.
+
+    Databases are HPCToolkit databases (or their experiment.xml files) by mpi_proc, as in
+    profile_flash(); mpi_proc 0 counts as 1 rank. Time of a node is its inclusive metric summed
+    over all ranks and samples, divided by their number, and the smallest mpi_proc is the base.
+    Efficiency is speedup times base ranks divided by ranks.
+
+    Result has "program" table (rows of mpi_proc, ranks, time, speedup and efficiency), and
+    "procedures" tables of procedures on the hot path of the base database, and of procedures
+    taking at least min_share of program time in it, along with slope of their efficiency against
+    log2 of ranks. Procedures are sorted by that slope, and those whose
+    efficiency degrades faster than that of the whole program are flagged as "degrading".
+    """
+    sum_metric = '{}:Sum (I)'.format(metric)
+    sources_metric = '{}:Mean:num-src (I)'.format(metric)
+    mpi_processes = sorted(databases)
+    assert len({max(_, 1) for _ in mpi_processes}) > 1, 'at least 2 numbers of ranks needed'
+    tables = {mpi_proc: load_experiment(_experiment_xml_path(databases[mpi_proc]))
+              for mpi_proc in mpi_processes}
+    times = {}
+    for mpi_proc, table in tables.items():
+        sources = max(table['metrics'].get(sources_metric, ()), default=0) or max(mpi_proc, 1)
+        times[mpi_proc] = {path: value / sources for path, value
+                           in _inclusive_by_procedure_path(table, sum_metric).items()}
+        column = table['metrics'][sum_metric]
+        total = column[0] or sum(column[row] for row, parent in enumerate(table['parent'])
+                                 if parent == 0)
+        times[mpi_proc][()] = total / sources
+
+    def scaling_table(path):
+        base = mpi_processes[0]
+        rows = []
+        for mpi_proc in mpi_processes:
+            time_ = times[mpi_proc].get(path)
+            speedup = times[base][path] / time_ if time_ else None
+            rows.append({'mpi_proc': mpi_proc, 'ranks': max(mpi_proc, 1), 'time': time_,
+                         'speedup': speedup, 'efficiency': None if speedup is None
+                         else speedup * max(base, 1) / max(mpi_proc, 1)})
+        return rows
+
+    def slope(rows):
+        rows = [row for row in rows if row['efficiency'] is not None]
+        return _efficiency_slope([row['ranks'] for row in rows],
+                                 [row['efficiency'] for row in rows])
+
+    program = scaling_table(())
+    program_slope = slope(program)
+    base_table = tables[mpi_processes[0]]
+    base_times = times[mpi_processes[0]]
+    paths = _procedure_paths(base_table)
+    rows = {}
+    for row in hot_path(base_table, sum_metric, hot_path_threshold):
+        rows.setdefault(paths[row], row)
+    for row, path in enumerate(paths):
+        if base_times.get(path, 0) >= min_share * base_times[()]:
+            rows.setdefault(path, row)
+    procedures = []
+    for path, row in rows.items():
+        if base_table['kind'][row] not in ('procedure', 'alien') or not base_times.get(path):
+            continue
+        procedure_table = scaling_table(path)
+        procedure_slope = slope(procedure_table)
+        procedures.append({
+            'procedure': base_table['procedure'][row], 'file': base_table['file'][row],
+            'path': path, 'scaling': procedure_table, 'efficiency_slope': procedure_slope,
+            'degrading': procedure_slope < program_slope})
+    procedures.sort(key=lambda procedure: procedure['efficiency_slope'])
+    return {'metric': metric, 'program': program, 'efficiency_slope': program_slope,
+            'procedures': procedures}
+
+
+def strong_scaling_dataframes(scaling: dict):
+    """Convert result of strong_scaling() into pandas DataFrames: program and procedures."""
+    import pandas as pd
+    program = pd.DataFrame(scaling['program']).set_index('mpi_proc')
+    procedures = pd.DataFrame([
+        dict(procedure=procedure['procedure'], file=procedure['file'],
+             efficiency_slope=procedure['efficiency_slope'], degrading=procedure['degrading'],
+             **row) for procedure in scaling['procedures'] for row in procedure['scaling']])
+    return program, procedures
+
+
+def _procedure_statistics(table: dict, metric: str) -> t.Dict[str, dict]:
+    """Per-source statistics of inclusive metric of each procedure, by procedure name.
+
+    Sources are all sources of the database (ranks, threads and samples), including those in
+    which a procedure took no time. Standard deviation of each calling context is computed from
+    its sum of squares ("StdDev:accum2" metric) if it is in the database, otherwise StdDev or
+    CfVar metrics are used as they are.
+
+    Calls of the same procedure in different contexts are combined, except recursive calls.
+    Per-source sums over contexts are not in the database, so standard deviation of a procedure
+    called in more than one context is the sum of standard deviations of its contexts -- an upper
+    bound, exact only if the contexts are perfectly correlated.
+    """
+    metrics = table['metrics']
+    columns = {name: metrics.get('{}:{} (I)'.format(metric, name)) for name in (
+        'Sum', 'Mean:num-src', 'StdDev', 'StdDev:accum2', 'CfVar')}
+    sources = max(columns['Mean:num-src'] or (), default=0) or 1
+    results = {}
+    for row, (kind, path) in enumerate(zip(table['kind'], _procedure_paths(table))):
+        if kind not in ('procedure', 'alien') or path[-1] in path[:-1]:
+            continue
+        mean = columns['Sum'][row] / sources
+        if columns['StdDev:accum2'] is not None:
+            stddev = math.sqrt(max(columns['StdDev:accum2'][row] / sources - mean ** 2, 0.0))
+        elif columns['StdDev'] is not None:
+            stddev = columns['StdDev'][row]
+        elif columns['CfVar'] is not None:
+            stddev = columns['CfVar'][row] * mean
+        else:
+            stddev = None
+        procedure = results.setdefault(
+            path[-1], {'mean': 0.0, 'stddev': 0.0, 'sources': sources, 'contexts': 0})
+        procedure['mean'] += mean
+        procedure['stddev'] = None if stddev is None or procedure['stddev'] is None \
+            else procedure['stddev'] + stddev
+        procedure['contexts'] += 1
+    return results
+
+
+def compare_profiles(base_database: pathlib.Path, database: pathlib.Path,
+                     metric: str = 'CPUTIME (usec)', threshold: float = 0.05,
+                     min_share: float = 0.01) -> t.List[dict]:
+    """Compare two HPCToolkit databases procedure by procedure, to find performance regressions.
+
+    Procedures taking at least min_share of program time in either database are compared.
+    Difference of mean inclusive metric per source is significant if Welch's t-test says so
+    at 95% confidence level, and a procedure is a regression if it is significantly slower than
+    in base database by more than threshold (relative to base). If variance is not known
+    (or is zero), significance is None and the procedure is not a regression.
+
+    Result is sorted from the most slowed down procedure. Procedures present in only one of the
+    databases (e.g. outlined or inlined by transpilation) have None as mean in the other.
+    """
+    base = _procedure_statistics(load_experiment(_experiment_xml_path(base_database)), metric)
+    other = _procedure_statistics(load_experiment(_experiment_xml_path(database)), metric)
+    base_total = max(_['mean'] for _ in base.values())
+    other_total = max(_['mean'] for _ in other.values())
+    results = []
+    for procedure in set(base) | set(other):
+        stats_a, stats_b = base.get(procedure), other.get(procedure)
+        if (stats_a is None or stats_a['mean'] < min_share * base_total) \
+                and (stats_b is None or stats_b['mean'] < min_share * other_total):
+            continue
+        result = {
+            'procedure': procedure,
+            'base_mean': None if stats_a is None else stats_a['mean'],
+            'base_stddev': None if stats_a is None else stats_a['stddev'],
+            'base_sources': None if stats_a is None else stats_a['sources'],
+            'mean': None if stats_b is None else stats_b['mean'],
+            'stddev': None if stats_b is None else stats_b['stddev'],
+            'sources': None if stats_b is None else stats_b['sources'],
+            'slowdown': None, 't': None, 'significant': None, 'regression': False}
+        if stats_a is not None and stats_b is not None and stats_a['mean']:
+            result['slowdown'] = stats_b['mean'] / stats_a['mean'] - 1
+            # significance is unknown without variance, e.g. with only one source
+            if stats_a['sources'] >= 2 and stats_b['sources'] >= 2 \
+                    and stats_a['stddev'] is not None and stats_b['stddev'] is not None:
+                variance_a = stats_a['stddev'] ** 2 / stats_a['sources']
+                variance_b = stats_b['stddev'] ** 2 / stats_b['sources']
+                if variance_a + variance_b:
+                    dof = (variance_a + variance_b) ** 2 / (
+                        variance_a ** 2 / (stats_a['sources'] - 1)
+                        + variance_b ** 2 / (stats_b['sources'] - 1))
+                    result['t'] = (stats_b['mean'] - stats_a['mean']) \
+                        / math.sqrt(variance_a + variance_b)
+                    result['significant'] = abs(result['t']) > _t_95(dof + 1)
+            result['regression'] = bool(result['significant']) \
+                and result['slowdown'] > threshold
+        results.append(result)
+    results.sort(key=lambda result: -math.inf if result['slowdown'] is None
+                 else result['slowdown'], reverse=True)
+    return results
+
+
+def hot_source_files(database: pathlib.Path, setup_dir: pathlib.Path, objdir: str, top: int = 5,
+                     metric: str = 'CPUTIME (usec)') -> t.List[dict]:
+    """Find FLASH source files of top procedures by inclusive metric in an HPCToolkit database.
+
+    Files recorded in the database are usually in the objdir. They are mapped back to the source
+    tree by following objdir links, or by file name if it is unique within the source tree.
+    Procedures not in Fortran files of the source tree (e.g. from libraries) are skipped.
+    Result has the first top procedures that could be mapped, from the hottest: procedure name,
+    mean inclusive metric per source and path of the source file.
+    """
+    table = load_experiment(_experiment_xml_path(database))
+    files = {}
+    for kind, procedure, file in zip(table['kind'], table['procedure'], table['file']):
+        if kind == 'procedure' and file is not None:
+            files.setdefault(procedure, file)
+    source_dir = setup_dir.joinpath('source').resolve()
+    hot = []
+    statistics_ = _procedure_statistics(table, metric)
+    for procedure in sorted(statistics_, key=lambda _: statistics_[_]['mean'], reverse=True):
+        if len(hot) == top:
+            break
+        file_name = pathlib.Path(files.get(procedure, '')).name
+        if pathlib.Path(file_name).suffix not in FORTRAN_SUFFIXES:
+            continue
+        path = setup_dir.joinpath(objdir, file_name).resolve()
+        if source_dir not in path.parents:
+            candidates = list(source_dir.glob('**/{}'.format(file_name)))
+            if len(candidates) != 1:
+                _LOG.warning('%s: cannot find unique source file "%s" of %s, skipping it',
+                             database, file_name, procedure)
+                continue
+            path = candidates[0]
+        hot.append({'procedure': procedure, 'mean': statistics_[procedure]['mean'],
+                    'path': path})
+    return hot
+
+
+def profile_guided_transpilation(app_name: str, experiment: str, objdir: str, sample_size: int,
+                                 top: int = 5, metric: str = 'CPUTIME (usec)',
+                                 branch: str = None, workers: int = None, timeout: float = None,
+                                 *, test_name: str, **kwargs) -> t.List[dict]:
+    """Transpile source files of the hottest procedures of FLASH, and profile it before and after.
+
+    FLASH is built and profiled as "{test_name}_before", then files of top procedures found by
+    hot_source_files() are transpiled, and FLASH is built and profiled as "{test_name}_after".
+    Original source files are restored afterwards. If branch is given, its worktree is used, see
+    branch_worktree(), otherwise the application repository as it is. Other keyword arguments
+    are passed to profile_flash().
+
+    Return report with one entry per selected procedure: its source file, transpilation status
+    and comparison of before and after timing, see compare_profiles(). The report is also
+    written to "profile_guided.json" in logs of test_name.
+    """
+    from transpiling_flash import transpile_batch
+    app_dir = pathlib.Path(_HERE, app_name) if branch is None else branch_worktree(app_name, branch)
+    setup_dir = _setup_dir(app_name, app_dir)
+    before, after = '{}_before'.format(test_name), '{}_after'.format(test_name)
+    env = spack_environment(flash_dimensionality(experiment))
+    executable = build_flash(experiment, objdir, setup_dir, env=env, test_name=before)
+    profile_flash(app_name, executable, app_dir, sample_size, **kwargs, env=env,
+                  test_name=before)
+    hot = hot_source_files(profile_db_path(test_name=before), setup_dir, objdir, top, metric)
+    paths = sorted({procedure['path'] for procedure in hot})
+    _LOG.warning('%s: transpiling %s', test_name, [str(path) for path in paths])
+    try:
+        with timed_phase(test_name=test_name, phase_name='transpile'):
+            transpiled = {result['path']: result for result in transpile_batch(
+                paths, workers, timeout,
+                summary_path=logs_path(test_name=test_name).joinpath('transpile_summary.json'))}
+        executable = build_flash(experiment, objdir, setup_dir, env=env, test_name=after)
+        profile_flash(app_name, executable, app_dir, sample_size, **kwargs, env=env,
+                      test_name=after)
+    finally:
+        for path in paths:
+            backup_path = path.with_suffix(path.suffix + '.bak')
+            if backup_path.is_file():
+                backup_path.replace(path)
+    comparison = {result['procedure']: result for result in compare_profiles(
+        profile_db_path(test_name=before), profile_db_path(test_name=after), metric,
+        min_share=0)}
+    report = []
+    for procedure in hot:
+        result = comparison.get(procedure['procedure'], {})
+        report.append({
+            'procedure': procedure['procedure'], 'path': str(procedure['path']),
+            'transpilation': transpiled[str(procedure['path'])]['status'],
+            'before': result.get('base_mean'), 'after': result.get('mean'),
+            'slowdown': result.get('slowdown'), 'significant': result.get('significant')})
+    report_path = logs_path(test_name=test_name).joinpath('profile_guided.json')
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with report_path.open('w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Compare HPCToolkit databases of FLASH procedure by procedure, and exit with'
+        ' non-zero status if any procedure is significantly slower than in base database.')
+    parser.add_argument('base_database', type=pathlib.Path, help='database of base branch')
+    parser.add_argument('database', type=pathlib.Path, help='database of compared branch')
+    parser.add_argument('-m', '--metric', default='CPUTIME (usec)',
+                        help='metric to compare (default: %(default)s)')
+    parser.add_argument('-t', '--threshold', type=float, default=0.05,
+                        help='relative slowdown tolerated even if significant'
+                        ' (default: %(default)s)')
+    parser.add_argument('--min-share', type=float, default=0.01,
+                        help='ignore procedures taking less than this share of program time'
+                        ' (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=pathlib.Path, default=None,
+                        help='write comparison also to this JSON file')
+    parsed_args = parser.parse_args(args)
+
+    results = compare_profiles(parsed_args.base_database, parsed_args.database,
+                               parsed_args.metric, parsed_args.threshold, parsed_args.min_share)
+    if parsed_args.output is not None:
+        with parsed_args.output.open('w') as output_file:
+            json.dump(results, output_file, indent=2)
+    for result in results:
+        _LOG.info('%s', result)
+    regressions = [result for result in results if result['regression']]
+    _LOG.warning('%i of %i procedures significantly slower by more than %.1f%%%s',
+                 len(regressions), len(results), 100 * parsed_args.threshold,
+                 ''.join('\n  {}: {:+.1%}'.format(result['procedure'], result['slowdown'])
+                         for result in regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    raise SystemExit(main())
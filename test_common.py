@@ -0,0 +1,75 @@
+"""Tests of utilities shared by the FLASH test and profiling scripts."""
+
+import collections
+import fcntl
+import io
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import common
+from common import TAIL_LINE_LENGTH, _stream_output, evict_flash_builds, restore_flash_build, \
+    run_on_cores, store_flash_build
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.path = pathlib.Path(self._tmpdir.name)
+
+    def test_evict_flash_builds(self):
+        cache_root = self.path.joinpath('build_cache')
+        patcher = unittest.mock.patch.object(common, '_BUILD_CACHE_ROOT', cache_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for i in range(4):
+            build_dir = self.path.joinpath('setup_{}'.format(i), 'object')
+            build_dir.mkdir(parents=True)
+            build_dir.joinpath('flash4').write_bytes(b'\0' * 1000)
+            store_flash_build('key_{}'.format(i), build_dir)
+            os.utime(str(cache_root.joinpath('key_{}'.format(i))), (i, i))
+        self.assertTrue(restore_flash_build('key_0', self.path.joinpath('setup_9', 'object')))
+        with cache_root.joinpath('key_1.lock').open('w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            evict_flash_builds(2500)
+        self.assertEqual(sorted(_.name for _ in cache_root.iterdir() if _.is_dir()),
+                         ['key_0', 'key_1'])
+
+    def test_stream_output(self):
+        output = 'x' * (3 * TAIL_LINE_LENGTH) + '\nzażółć\n\nno line break'
+        for chunk_size in (7, common.STREAM_CHUNK_SIZE):
+            log_file, tail, echo = io.BytesIO(), collections.deque(maxlen=3), io.StringIO()
+            with unittest.mock.patch.object(common, 'STREAM_CHUNK_SIZE', chunk_size):
+                _stream_output(io.BufferedReader(io.BytesIO(output.encode())), log_file, tail,
+                               echo)
+            self.assertEqual(log_file.getvalue(), output.encode())
+            self.assertEqual(echo.getvalue(), output)
+            self.assertEqual(list(tail), ['zażółć\n'.encode(), b'\n', b'no line break'])
+        tail = collections.deque(maxlen=4)
+        _stream_output(io.BufferedReader(io.BytesIO(output.encode())), io.BytesIO(), tail)
+        self.assertEqual(tail[0], b'x' * TAIL_LINE_LENGTH + b'\n')
+
+    def test_run_on_cores(self):
+        lock = threading.Lock()
+        busy_cores = set()
+
+        def job(cores):
+            with lock:
+                self.assertFalse(busy_cores & set(cores))
+                busy_cores.update(cores)
+            time.sleep(0.01)
+            with lock:
+                busy_cores.difference_update(cores)
+            return cores
+
+        results = run_on_cores([(1, job), (3, job), (2, job), (0, job), (8, job)], [4, 5, 6, 7])
+        self.assertEqual([len(_) for _ in results], [1, 3, 2, 1, 4])
+        for cores in results:
+            self.assertTrue(set(cores) <= {4, 5, 6, 7})
+            self.assertEqual(len(set(cores)), len(cores))
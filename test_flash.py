@@ -8,11 +8,14 @@ import subprocess
 import unittest
 
 import git
-from transpyle.general import CodeReader, CodeWriter
-from transpyle.fortran import FortranParser, FortranAstGeneralizer, Fortran2008Unparser
 
 import common
-from common import _run_and_check
+from common import flash_build_key, flash_build_lock, restore_flash_build, store_flash_build, \
+    flash_dimensionality, logs_path, monitor_path, monitor_process_tree, spack_environment, \
+    timed_phase, wait_for_process, _run_and_check
+import comparing_flash
+from comparing_flash import compare_outputs, find_outputs, mismatches
+from transpiling_flash import TranspilerPool, fortran_to_fortran
 
 logging.basicConfig()
 
@@ -20,34 +23,19 @@ _LOG = logging.getLogger(__name__)
 
 _HERE = pathlib.Path(__file__).parent.resolve()
 
-common._NOW = datetime.datetime.now()
+# where FLASH repositories are, see testing_flash module for running tests in other workspaces
+_WORKSPACE = pathlib.Path(os.environ.get('FLASH_TESTS_WORKSPACE', str(_HERE))).resolve()
 
+# whether builds can be restored from the build cache even when not running quick tests
+_SHARED_BUILDS = os.environ.get('FLASH_TESTS_SHARED_BUILDS') == '1'
 
-def fortran_to_fortran(path: pathlib.Path):
-    """Transpile Fortran to Fortran, using Python AST as intermediate (generalized) format.
+common._NOW = datetime.datetime.now()
 
-    Reader reads the code.
-    Parser creates a Fortran-specific AST.
-    Generalizer transforms it into AST that can be easily processed and unparsed into many outputs.
-    Unparsers creates Fortran code from the same generalized AST.
-    Original file is moved from "name.ext" to "name.ext.bak", unless the backup already exists.
-    Writer writes the transpiled file to where the original file was.
-    """
-    reader = CodeReader()
-    parser = FortranParser()
-    generalizer = FortranAstGeneralizer()
-    unparser = Fortran2008Unparser()
-    writer = CodeWriter(path.suffix)
+_TRANSPILER_POOL = TranspilerPool()
 
-    code = reader.read_file(path)
-    fortran_ast = parser.parse(code, path)
-    tree = generalizer.generalize(fortran_ast)
-    fortran_code = unparser.unparse(tree)
 
-    backup_path = path.with_suffix(path.suffix + '.bak')
-    if not backup_path.is_file():
-        pathlib.Path.rename(path, backup_path)
-    writer.write_file(fortran_code, path)
+def tearDownModule():
+    _TRANSPILER_POOL.close()
 
 
 class FlashTests(unittest.TestCase):
@@ -61,42 +49,81 @@ class FlashTests(unittest.TestCase):
 
     timeout = None  # type: int
 
+    # tolerances of comparison of outputs before and after transpilation, see compare_outputs()
+    rtol = 1e-12
+    atol = 0.0
+
+    @classmethod
+    def cores_needed(cls) -> int:
+        """Number of cores that running FLASH in this test occupies."""
+        if '-np' in cls.run_cmd:
+            return int(cls.run_cmd[cls.run_cmd.index('-np') + 1])
+        return 1
+
     def setUp(self):
         if type(self) is FlashTests:
             self.skipTest('...')
-        repo = git.Repo(str(pathlib.Path(_HERE, self.root_path)), search_parent_directories=True)
+        repo = git.Repo(str(pathlib.Path(_WORKSPACE, self.root_path)),
+                        search_parent_directories=True)
         repo_path = pathlib.Path(repo.working_dir)
-        self.assertIn(str(_HERE), str(repo_path), msg=(repo_path, _HERE, repo))
-        self.assertNotEqual(repo_path, _HERE, msg=(repo_path, _HERE, repo))
+        self.assertIn(str(_WORKSPACE), str(repo_path), msg=(repo_path, _WORKSPACE, repo))
+        self.assertNotEqual(repo_path, _WORKSPACE, msg=(repo_path, _WORKSPACE, repo))
         repo_is_dirty = repo.is_dirty(untracked_files=True)
         if repo_is_dirty and self.clean_repo:
             repo.git.clean(f=True, d=True, x=True)
             repo.git.reset(hard=True)
             _LOG.warning('Repository %s has been cleaned and reset.', repo)
 
+    def _absolute_transpiled_paths(self, transpiled_paths):
+        return [pathlib.Path(_WORKSPACE, self.root_path, self.source_path, path)
+                for path in transpiled_paths]
+
     def run_transpyle(self, transpiled_paths):
-        absolute_transpiled_paths = [pathlib.Path(_HERE, self.root_path, self.source_path, path)
-                                     for path in transpiled_paths]
+        absolute_transpiled_paths = self._absolute_transpiled_paths(transpiled_paths)
         if not absolute_transpiled_paths:
             return
         all_failed = True
         for path in absolute_transpiled_paths:
             self.assertTrue(path.is_file())
-            with self.subTest(path=path):
-                fortran_to_fortran(path)
+            with self.subTest(path=path), \
+                    timed_phase(test_name=self.id(), phase_name='transpile.{}'.format(path.name)):
+                fortran_to_fortran(path, pool=_TRANSPILER_POOL)
                 all_failed = False
         if all_failed:
             self.fail(msg='Failed to transpile any of the files {}.'
                       .format(absolute_transpiled_paths))
 
-    def _run_and_check(self, cmd, wd, log_filename_prefix):
-        _run_and_check(cmd, wd, test_name=self.id(), phase_name=log_filename_prefix)
-
-    def run_flash(self, flash_args, object_path: pathlib.Path = None, quick: bool = False):
-        if object_path is None:
-            object_path = pathlib.Path('object')
-        absolute_flash_path = pathlib.Path(_HERE, self.root_path)
-        absolute_object_path = pathlib.Path(_HERE, self.root_path, object_path)
+    def _run_and_check(self, cmd, wd, log_filename_prefix, env=None):
+        _run_and_check(cmd, wd, env, test_name=self.id(), phase_name=log_filename_prefix)
+
+    def relink_transpiled(self, transpiled_paths, absolute_object_path: pathlib.Path):
+        """Make sure that objdir uses transpiled sources, and return False if it can't be done.
+
+        Sources linked into the objdir by setup already point to the transpiled files. Sources that
+        setup copied into the objdir are replaced by links to the transpiled files.
+        """
+        for path in self._absolute_transpiled_paths(transpiled_paths):
+            object_file_path = absolute_object_path.joinpath(path.name)
+            if object_file_path.is_symlink() and object_file_path.resolve() == path.resolve():
+                continue
+            backup_path = path.with_suffix(path.suffix + '.bak')
+            if not object_file_path.is_file() or not backup_path.is_file() \
+                    or object_file_path.read_bytes() != backup_path.read_bytes():
+                _LOG.warning('Objdir file "%s" does not come from "%s".', object_file_path, path)
+                return False
+            object_file_path.unlink()
+            object_file_path.symlink_to(path)
+        return True
+
+    def run_flash(self, flash_args, object_path: pathlib.Path = None, quick: bool = False,
+                  transpiled_paths=None):
+        """Set up, build and run FLASH.
+
+        If transpiled_paths are given and objdir exists, setup is skipped and the build is
+        incremental: only transpiled sources and what depends on them is recompiled.
+        """
+        absolute_flash_path = pathlib.Path(_WORKSPACE, self.root_path)
+        absolute_object_path = self._absolute_object_path(object_path)
         if isinstance(flash_args, str):
             flash_args = flash_args.split(' ')
         flash_setup_cmd = self.setup_cmd + flash_args
@@ -104,37 +131,92 @@ class FlashTests(unittest.TestCase):
         flash_make_cmd = self.make_cmd
         flash_run_cmd = self.run_cmd
 
+        env = spack_environment(flash_dimensionality(flash_args))
+        build_key = flash_build_key(absolute_flash_path, ' '.join(flash_setup_cmd), env=env)
+
         something_wrong = True
         with self.subTest(flash_path=absolute_flash_path, setup_cmd=flash_setup_cmd,
                           make_cmd=flash_make_cmd, run_cmd=flash_run_cmd):
-            if quick and absolute_object_path.is_dir():
-                _LOG.warning('Skipping setup & build -- objdir "%s" already exists.', object_path)
-            else:
-                _LOG.warning('Setting up FLASH...')
-                self._run_and_check(flash_setup_cmd, absolute_flash_path, 'setup')
-                _LOG.warning('Setup succeeded.')
-
-                _LOG.warning('Building FLASH...')
-                self._run_and_check(flash_make_cmd, absolute_object_path, 'make')
-                _LOG.warning('Build succeeded.')
+            with flash_build_lock(build_key):
+                restore = quick or _SHARED_BUILDS
+                if restore and restore_flash_build(build_key, absolute_object_path):
+                    _LOG.warning('Skipping setup & build -- objdir "%s" restored from cache.',
+                                 absolute_object_path.name)
+                elif transpiled_paths and absolute_object_path.is_dir() \
+                        and self.relink_transpiled(transpiled_paths, absolute_object_path):
+                    _LOG.warning('Rebuilding FLASH incrementally...')
+                    self._run_and_check(flash_make_cmd, absolute_object_path, 'make.incremental',
+                                        env)
+                    _LOG.warning('Build succeeded.')
+                    store_flash_build(build_key, absolute_object_path)
+                else:
+                    _LOG.warning('Setting up FLASH...')
+                    self._run_and_check(flash_setup_cmd, absolute_flash_path, 'setup', env)
+                    _LOG.warning('Setup succeeded.')
+
+                    _LOG.warning('Building FLASH...')
+                    self._run_and_check(flash_make_cmd, absolute_object_path, 'make', env)
+                    _LOG.warning('Build succeeded.')
+                    store_flash_build(build_key, absolute_object_path)
 
             try:
-                run_result = subprocess.run(' '.join(flash_run_cmd), shell=True,
-                                            cwd=str(absolute_object_path), timeout=self.timeout)
-                self.assertEqual(run_result.returncode, 0, msg=run_result)
+                with timed_phase(test_name=self.id(), phase_name='run') as phase:
+                    process = subprocess.Popen(' '.join(flash_run_cmd), shell=True,
+                                               cwd=str(absolute_object_path), env=env)
+                    with monitor_process_tree(process.pid, monitor_path(
+                            test_name=self.id(), phase_name='run')) as peak:
+                        try:
+                            phase['returncode'] = wait_for_process(
+                                process, self.timeout, peak)['returncode']
+                        except subprocess.TimeoutExpired:
+                            process.kill()
+                            process.wait()
+                            raise
+                self.assertEqual(process.returncode, 0, msg=process.args)
             except subprocess.TimeoutExpired:
                 _LOG.warning('Test %s takes a long time.', self.id(), exc_info=1)
             something_wrong = False
         if something_wrong:
             self.fail('FLASH setup, build, or run failed.')
 
+    def _absolute_object_path(self, object_path: pathlib.Path = None) -> pathlib.Path:
+        if object_path is None:
+            object_path = pathlib.Path('object')
+        return pathlib.Path(_WORKSPACE, self.root_path, object_path)
+
+    def keep_reference_outputs(self, object_path: pathlib.Path = None) -> pathlib.Path:
+        """Move checkpoint and plot files out of objdir, so that next run doesn't overwrite them."""
+        reference_path = logs_path(test_name=self.id()).joinpath('reference_outputs')
+        reference_path.mkdir(parents=True, exist_ok=True)
+        for path in find_outputs(self._absolute_object_path(object_path)):
+            path.replace(reference_path.joinpath(path.name))
+        return reference_path
+
+    def compare_outputs(self, reference_path: pathlib.Path, object_path: pathlib.Path = None):
+        """Compare outputs of a run to reference outputs, variable by variable, block by block."""
+        if comparing_flash.h5py is None:
+            self.skipTest('h5py is needed to compare outputs')
+        paths = find_outputs(self._absolute_object_path(object_path))
+        self.assertEqual([path.name for path in paths],
+                         [path.name for path in find_outputs(reference_path)])
+        for path in paths:
+            with self.subTest(output=path.name), \
+                    timed_phase(test_name=self.id(), phase_name='compare.{}'.format(path.name)):
+                results = compare_outputs(path, reference_path.joinpath(path.name),
+                                          rtol=self.rtol, atol=self.atol)
+                self.assertFalse(mismatches(results), msg=results)
+
     def run_problem(self, transpiled_paths, flash_args, object_path=None, pre_verify=True,
                     quick: bool = False):
         assert not (transpiled_paths and quick)
         if pre_verify:
             self.run_flash(flash_args, object_path, quick)
+            reference_path = self.keep_reference_outputs(object_path)
         self.run_transpyle(transpiled_paths)
-        self.run_flash(flash_args, object_path, quick)
+        self.run_flash(flash_args, object_path, quick,
+                       transpiled_paths=transpiled_paths if pre_verify else None)
+        if pre_verify and transpiled_paths:
+            self.compare_outputs(reference_path, object_path)
 
     def run_sod_problem(self, transpiled_paths, **kwargs):
         args = 'Sod -auto -2d'
@@ -0,0 +1,210 @@
+"""Tests of analysis of HPCToolkit profiles, on synthetic experiment.xml files."""
+
+import math
+import pathlib
+import pickle
+import random
+import statistics
+import tempfile
+import unittest
+import xml.sax.saxutils
+
+from profiling_flash import _parse_experiment_xml, _procedure_statistics, compare_profiles, \
+    load_experiment, strong_scaling
+
+_METRICS = ('Sum', 'Mean:num-src', 'StdDev', 'StdDev:accum2')
+
+
+def _metric_values(values):
+    """Metrics of one node, as HPCToolkit stores them, given its value in each source."""
+    mean, stddev = statistics.mean(values), statistics.pstdev(values)
+    return {'Sum': sum(values), 'Mean:num-src': sum(1 for _ in values if _), 'StdDev': stddev,
+            'StdDev:accum2': sum(_ ** 2 for _ in values), 'CfVar': stddev / mean if mean else 0}
+
+
+def _experiment_xml(tree, metric_names=_METRICS) -> str:
+    """Create experiment.xml from a tree of (procedure name or None, values by source, children).
+
+    Nodes with procedure name are procedure frames, and the ones without are call sites.
+    Procedure frame of the program root is added on top of the tree. Metric names are a subset
+    of the ones computed by _metric_values().
+    """
+    procedures = {}
+    lines = []
+
+    def add_node(node, depth):
+        name, values, children = node
+        if name is None:
+            tag, attributes = 'C', 'i="{}" l="{}"'.format(len(lines) + 1, depth)
+        else:
+            procedure_id = procedures.setdefault(name, len(procedures) + 1)
+            tag, attributes = 'PF', 'i="{}" n="{}" f="1" l="{}"'.format(
+                len(lines) + 1, procedure_id, depth)
+        metrics = ''.join('<M n="{}" v="{!r}"/>'.format(i, float(value)) for i, value in enumerate(
+            _metric_values(values)[_] for _ in metric_names))
+        lines.append('<{} {}>{}'.format(tag, attributes, metrics))
+        for child in children:
+            add_node(child, depth + 1)
+        lines.append('</{}>'.format(tag))
+
+    add_node(('<program root>', tree[1], [tree]), 0)
+    metric_table = ''.join('<Metric i="{}" n="CPUTIME (usec):{} (I)"/>'.format(i, name)
+                           for i, name in enumerate(metric_names))
+    procedure_table = ''.join('<Procedure i="{}" n="{}"/>'.format(i, xml.sax.saxutils.escape(n))
+                              for n, i in procedures.items())
+    return ''.join([
+        '<?xml version="1.0"?>\n<HPCToolkitExperiment><SecCallPathProfile i="0" n="flash4">',
+        '<SecHeader><MetricTable>', metric_table, '</MetricTable>',
+        '<FileTable><File i="1" n="./src/flash.F90"/></FileTable>',
+        '<ProcedureTable>', procedure_table, '</ProcedureTable></SecHeader>',
+        '<SecCallPathProfileData>', *lines,
+        '</SecCallPathProfileData></SecCallPathProfile></HPCToolkitExperiment>'])
+
+
+def _two_context_tree(flux_1, flux_2, other):
+    """Program in which procedure "flux" is called from 2 contexts, and "eos" once."""
+    total = [a + b + c for a, b, c in zip(flux_1, flux_2, other)]
+    return ('main', total, [
+        (None, flux_1, [('flux', flux_1, [])]),
+        (None, flux_2, [('flux', flux_2, [])]),
+        (None, other, [('eos', other, [])])])
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+
+    def write_experiment(self, name, tree, metrics=_METRICS) -> pathlib.Path:
+        database = pathlib.Path(self._tmpdir.name, name)
+        database.mkdir()
+        database.joinpath('experiment.xml').write_text(_experiment_xml(tree, metrics))
+        return database
+
+    def test_parse_experiment_xml(self):
+        database = self.write_experiment('db', _two_context_tree([1, 2], [3, 4], [0, 5]))
+        table = _parse_experiment_xml(database.joinpath('experiment.xml'))
+        self.assertEqual(table['kind'], ['root', 'procedure', 'procedure', 'call site',
+                                         'procedure', 'call site', 'procedure', 'call site',
+                                         'procedure'])
+        self.assertEqual(table['procedure'][1:3], ['<program root>', 'main'])
+        self.assertEqual(table['procedure'][4::2], ['flux', 'flux', 'eos'])
+        self.assertEqual(list(table['parent']), [-1, 0, 1, 2, 3, 2, 5, 2, 7])
+        self.assertEqual(list(table['depth']), [0, 1, 2, 3, 4, 3, 4, 3, 4])
+        self.assertEqual(table['file'][1], './src/flash.F90')
+        self.assertIsNone(table['file'][3])
+        sums = table['metrics']['CPUTIME (usec):Sum (I)']
+        self.assertEqual(list(sums), [0, 15, 15, 3, 3, 7, 7, 5, 5])
+        self.assertEqual(table['metrics']['CPUTIME (usec):Mean:num-src (I)'][8], 1)
+
+    def test_load_experiment_cache(self):
+        path = self.write_experiment('db', _two_context_tree([1, 2], [3, 4], [0, 5])).joinpath(
+            'experiment.xml')
+        cache_path = path.with_suffix('.pickle')
+        table = load_experiment(path)
+        self.assertTrue(cache_path.is_file())
+        self.assertEqual(load_experiment(path)['procedure'], table['procedure'])
+        cache_path.write_bytes(cache_path.read_bytes()[:20])
+        self.assertEqual(load_experiment(path)['procedure'], table['procedure'])
+        with cache_path.open('wb') as cache_file:
+            pickle.dump({'mtime': path.stat().st_mtime, 'size': path.stat().st_size,
+                         'hash': None, 'table': None}, cache_file)  # from an older version
+        self.assertEqual(load_experiment(path)['procedure'], table['procedure'])
+        self.assertEqual(list(path.parent.glob('*.partial')), [])
+
+    def test_procedure_statistics(self):
+        flux_1, flux_2 = [10, 12, 11, 13], [5, 3, 6, 2]
+        other = [1, 1, 1, 1]
+        database = self.write_experiment('db', _two_context_tree(flux_1, flux_2, other))
+        stats = _procedure_statistics(
+            _parse_experiment_xml(database.joinpath('experiment.xml')), 'CPUTIME (usec)')
+        self.assertEqual(stats['flux']['sources'], 4)
+        self.assertEqual(stats['flux']['contexts'], 2)
+        flux = [a + b for a, b in zip(flux_1, flux_2)]
+        self.assertAlmostEqual(stats['flux']['mean'], statistics.mean(flux))
+        self.assertGreaterEqual(stats['flux']['stddev'], statistics.pstdev(flux))
+        self.assertAlmostEqual(stats['eos']['stddev'], 0)
+        self.assertAlmostEqual(stats['main']['stddev'], statistics.pstdev(
+            [a + b + c for a, b, c in zip(flux_1, flux_2, other)]))
+
+    def test_procedure_statistics_fallback(self):
+        flux_1, flux_2 = [10, 12, 11, 13], [5, 3, 6, 2]
+        other = [1, 2, 1, 2]
+        for metrics in (('Sum', 'Mean:num-src', 'StdDev'), ('Sum', 'Mean:num-src', 'CfVar')):
+            database = self.write_experiment(
+                'db_{}'.format(metrics[-1]), _two_context_tree(flux_1, flux_2, other), metrics)
+            stats = _procedure_statistics(
+                _parse_experiment_xml(database.joinpath('experiment.xml')), 'CPUTIME (usec)')
+            self.assertAlmostEqual(stats['flux']['stddev'],
+                                   statistics.pstdev(flux_1) + statistics.pstdev(flux_2))
+            self.assertAlmostEqual(stats['eos']['stddev'], statistics.pstdev(other))
+            self.assertAlmostEqual(stats['main']['stddev'], statistics.pstdev(
+                [a + b + c for a, b, c in zip(flux_1, flux_2, other)]))
+        database = self.write_experiment(
+            'db', _two_context_tree(flux_1, flux_2, other), ('Sum', 'Mean:num-src'))
+        stats = _procedure_statistics(
+            _parse_experiment_xml(database.joinpath('experiment.xml')), 'CPUTIME (usec)')
+        self.assertAlmostEqual(stats['flux']['mean'], statistics.mean(flux_1 + flux_2) * 2)
+        self.assertIsNone(stats['flux']['stddev'])
+
+    def test_compare_profiles_noise(self):
+        generator = random.Random(0)
+
+        def noisy_tree():
+            return _two_context_tree([generator.gauss(100, 2) for _ in range(10)],
+                                     [generator.gauss(50, 2) for _ in range(10)],
+                                     [generator.gauss(20, 1) for _ in range(10)])
+        base = self.write_experiment('base', noisy_tree())
+        other = self.write_experiment('other', noisy_tree())
+        results = {_['procedure']: _ for _ in compare_profiles(base, other)}
+        self.assertGreater(results['flux']['base_stddev'], 0)
+        for result in results.values():
+            self.assertFalse(result['significant'], msg=result)
+            self.assertFalse(result['regression'], msg=result)
+
+    def test_compare_profiles_regression(self):
+        generator = random.Random(0)
+        base = self.write_experiment('base', _two_context_tree(
+            [generator.gauss(100, 2) for _ in range(10)],
+            [generator.gauss(50, 2) for _ in range(10)], [20] * 10))
+        other = self.write_experiment('other', _two_context_tree(
+            [generator.gauss(130, 2) for _ in range(10)],
+            [generator.gauss(65, 2) for _ in range(10)], [20] * 10))
+        results = {_['procedure']: _ for _ in compare_profiles(base, other)}
+        self.assertTrue(results['flux']['significant'])
+        self.assertTrue(results['flux']['regression'])
+        self.assertAlmostEqual(results['flux']['slowdown'], 0.3, delta=0.02)
+        self.assertIsNone(results['eos']['significant'])  # zero variance
+        self.assertFalse(results['eos']['regression'])
+
+    def test_compare_profiles_single_source(self):
+        base = self.write_experiment('base', _two_context_tree([100], [50], [20]))
+        other = self.write_experiment('other', _two_context_tree([200], [50], [20]))
+        results = {_['procedure']: _ for _ in compare_profiles(base, other)}
+        self.assertAlmostEqual(results['flux']['slowdown'], 2 / 3)
+        self.assertIsNone(results['flux']['significant'])
+        self.assertFalse(results['flux']['regression'])
+
+    def test_strong_scaling(self):
+        databases = {}
+        for mpi_proc in (0, 2, 4):
+            ranks = max(mpi_proc, 1)
+            # flux scales perfectly, eos does not scale at all
+            databases[mpi_proc] = self.write_experiment('db_{}'.format(mpi_proc), (
+                'main', [80 / ranks + 20] * ranks, [
+                    (None, [80 / ranks] * ranks, [('flux', [80 / ranks] * ranks, [])]),
+                    (None, [20] * ranks, [('eos', [20] * ranks, [])])]))
+        scaling = strong_scaling(databases)
+        self.assertEqual([_['ranks'] for _ in scaling['program']], [1, 2, 4])
+        self.assertEqual([_['time'] for _ in scaling['program']], [100, 60, 40])
+        self.assertEqual([_['speedup'] for _ in scaling['program']], [1, 100 / 60, 2.5])
+        self.assertAlmostEqual(scaling['program'][2]['efficiency'], 0.625)
+        procedures = {_['procedure']: _ for _ in scaling['procedures']}
+        self.assertEqual([_['efficiency'] for _ in procedures['flux']['scaling']], [1, 1, 1])
+        self.assertFalse(procedures['flux']['degrading'])
+        self.assertEqual([_['efficiency'] for _ in procedures['eos']['scaling']],
+                         [1, 0.5, 0.25])
+        self.assertTrue(procedures['eos']['degrading'])
+        self.assertEqual(scaling['procedures'][0]['procedure'], 'eos')
+        self.assertTrue(math.isclose(procedures['eos']['efficiency_slope'], -0.375))
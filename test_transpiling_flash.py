@@ -0,0 +1,64 @@
+"""Tests of batch transpilation machinery, with transpilation itself replaced by a stub."""
+
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import transpiling_flash
+from transpiling_flash import AstCache, TranspilerPool
+
+
+def _transpile_code_stub(path: pathlib.Path, ast_cache, parsers=None):
+    """Behave according to the name of the file, without reading it."""
+    if path.stem == 'crash':
+        os._exit(3)
+    if path.stem == 'hang':
+        time.sleep(60)
+    if path.stem == 'fail':
+        raise ValueError('cannot parse')
+    return 'transpiled {}'.format(path.name), False
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        patcher = unittest.mock.patch.object(
+            transpiling_flash, '_transpile_code', _transpile_code_stub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ast_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = AstCache(pathlib.Path(cache_dir), max_size=2500)
+            self.assertIsNone(cache.get('code 0', '.F90'))
+            for i in range(3):
+                cache.put('code {}'.format(i), '.F90', os.urandom(1000))
+                for path in cache.path.glob('*.pickle.gz'):
+                    os.utime(str(path), (path.stat().st_mtime - 1,) * 2)
+            self.assertIsNone(cache.get('code 0', '.F90'))  # evicted
+            self.assertIsNotNone(cache.get('code 1', '.F90'))
+            cache.put('code 3', '.F90', os.urandom(1000))
+            self.assertIsNone(cache.get('code 2', '.F90'))  # evicted, unlike recently used one
+            self.assertIsNotNone(cache.get('code 1', '.F90'))
+            self.assertIsNone(cache.get('code 1', '.f90'))
+            cache.put('code 4', '.F90', lambda: None)  # cannot be pickled
+            self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4, 'entries': 2})
+            self.assertEqual(list(cache.path.glob('*.partial')), [])
+
+    def test_transpiler_pool_restarts(self):
+        paths = [pathlib.Path('{}.F90'.format(_)) for _ in ('a', 'crash', 'b', 'hang', 'fail')]
+        with TranspilerPool(2, timeout=1, ast_cache=None) as pool:
+            results = {_['path']: _ for _ in pool.transpile_many(paths)}
+            self.assertEqual(pool.transpile(pathlib.Path('c.F90')), 'transpiled c.F90')
+            self.assertEqual(pool.restarts, 2)
+        self.assertEqual({path: _['status'] for path, _ in results.items()}, {
+            'a.F90': 'ok', 'crash.F90': 'failed', 'b.F90': 'ok', 'hang.F90': 'timeout',
+            'fail.F90': 'failed'})
+        self.assertEqual(results['a.F90']['fortran_code'], 'transpiled a.F90')
+        self.assertEqual(results['crash.F90']['error'], 'worker exited with code 3')
+        self.assertEqual(results['fail.F90']['error'], 'ValueError: cannot parse')
+        self.assertIsNone(results['hang.F90']['fortran_code'])
+        self.assertLess(results['hang.F90']['time'], 10)
@@ -0,0 +1,135 @@
+"""Utility functions to run FLASH tests concurrently, each in its own isolated workspace.
+
+Run all tests with:
+
+    python3 testing_flash.py
+
+Or only some of them, e.g.:
+
+    python3 testing_flash.py test_flash.NewTests test_flash.Flash45Tests.test_hy_uhd_Roe
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import typing as t
+import unittest
+
+import git
+
+import common
+from common import run_on_cores, _run_and_check
+
+_HERE = pathlib.Path(__file__).parent.resolve()
+
+_LOG = logging.getLogger(__name__)
+
+_WORKSPACES_ROOT = pathlib.Path(_HERE, 'workspaces')
+
+
+def _flatten(suite) -> t.Iterator[unittest.TestCase]:
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from _flatten(test)
+        else:
+            yield test
+
+
+def find_tests(names: t.Sequence[str] = ('test_flash',)) -> t.List[unittest.TestCase]:
+    """Find FLASH tests, given names of modules, test classes or test methods."""
+    import test_flash
+    suite = unittest.TestLoader().loadTestsFromNames(names)
+    return [test for test in _flatten(suite)
+            if isinstance(test, test_flash.FlashTests) and type(test) is not test_flash.FlashTests]
+
+
+def prepare_workspace(test: unittest.TestCase) -> pathlib.Path:
+    """Create workspace for a test, with a git worktree of the FLASH repository it uses.
+
+    Worktree is at the commit currently checked out in the main repository. The test is expected
+    to find FLASH at the same relative path in the workspace as in this repository.
+    """
+    type(test).setUpClass()
+    repo_name = pathlib.Path(test.root_path).parts[0]
+    repo = git.Repo(str(pathlib.Path(_HERE, repo_name)))
+    workspace = _WORKSPACES_ROOT.joinpath(test.id())
+    worktree_dir = workspace.joinpath(repo_name)
+    if worktree_dir.is_dir():
+        git.Repo(str(worktree_dir)).git.checkout(repo.head.commit.hexsha, detach=True)
+    else:
+        workspace.mkdir(parents=True, exist_ok=True)
+        repo.git.worktree('add', '--detach', str(worktree_dir), repo.head.commit.hexsha)
+    return workspace
+
+
+def remove_workspace(workspace: pathlib.Path):
+    for worktree_dir in workspace.iterdir():
+        git.Repo(str(worktree_dir)).git.worktree('remove', '--force', str(worktree_dir))
+    shutil.rmtree(str(workspace))
+
+
+def run_test(test: unittest.TestCase, workspace: pathlib.Path, cores: t.List[int]) -> bool:
+    """Run one test in a separate process, pinned to given cores, and return True if it passed.
+
+    Identical builds are shared between concurrently running tests via the build cache.
+    """
+    env_variables = 'FLASH_TESTS_WORKSPACE="{}" FLASH_TESTS_SHARED_BUILDS=1'.format(workspace)
+    command = '{} taskset -c {} {} -m unittest --verbose {}'.format(
+        env_variables, ','.join(str(core) for core in cores), sys.executable, test.id())
+    try:
+        _run_and_check(command, _HERE, test_name=test.id(), phase_name='unittest')
+    except AssertionError:
+        _LOG.exception('%s failed', test.id())
+        return False
+    return True
+
+
+def run_tests(tests: t.Sequence[unittest.TestCase], cores: t.Sequence[int] = None,
+              keep_workspaces: bool = False) -> t.Dict[str, bool]:
+    """Run tests concurrently, within a global budget of cores.
+
+    Each test gets as many cores as it runs MPI processes, see FlashTests.cores_needed().
+    Workspaces of passed tests are removed unless keep_workspaces is True.
+    """
+    workspaces = [prepare_workspace(test) for test in tests]
+    results = run_on_cores([
+        (test.cores_needed(), lambda cores, test=test, workspace=workspace: run_test(
+            test, workspace, cores))
+        for test, workspace in zip(tests, workspaces)], cores)
+    for passed, workspace in zip(results, workspaces):
+        if passed and not keep_workspaces:
+            remove_workspace(workspace)
+    return {test.id(): passed for test, passed in zip(tests, results)}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run FLASH tests concurrently, each in an isolated workspace.')
+    parser.add_argument('names', metavar='NAME', nargs='*', default=['test_flash'],
+                        help='test module, class or method (default: test_flash)')
+    parser.add_argument('-c', '--cores', type=int, default=None,
+                        help='total number of cores to use (default: all available)')
+    parser.add_argument('--keep-workspaces', action='store_true',
+                        help='keep workspaces also of passed tests')
+    parsed_args = parser.parse_args(args)
+
+    common._NOW = datetime.datetime.now()
+    cores = sorted(os.sched_getaffinity(0))
+    if parsed_args.cores is not None:
+        cores = cores[:parsed_args.cores]
+    tests = find_tests(parsed_args.names)
+    _LOG.warning('running %i tests on %i cores...', len(tests), len(cores))
+    results = run_tests(tests, cores, parsed_args.keep_workspaces)
+    failed = [test_id for test_id, passed in results.items() if not passed]
+    _LOG.warning('%i of %i tests passed%s', len(results) - len(failed), len(results),
+                 ''.join('\n  failed: {}'.format(test_id) for test_id in failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    raise SystemExit(main())
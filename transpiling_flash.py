@@ -0,0 +1,422 @@
+"""Utility functions to assist transpiling FLASH source code, file by file or in batches."""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import importlib
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pathlib
+import pickle
+import signal
+import tempfile
+import time
+import typing as t
+import xml.etree.ElementTree as ET
+
+import open_fortran_parser.config
+import transpyle
+from transpyle.general import CodeReader, CodeWriter
+from transpyle.fortran import FortranParser, FortranAstGeneralizer, Fortran2008Unparser
+
+try:
+    import jpype
+except ImportError:
+    jpype = None
+
+import common
+from common import FORTRAN_SUFFIXES, logs_path
+
+_HERE = pathlib.Path(__file__).parent.resolve()
+
+_LOG = logging.getLogger(__name__)
+
+# workers are forked, so that a restarted worker needn't import transpyle again
+_FORK = multiprocessing.get_context('fork')
+
+
+def _transpyle_version() -> str:
+    version = getattr(transpyle, '__version__', None)
+    if version is None:
+        version = importlib.import_module('transpyle._version').VERSION
+    return str(version)
+
+
+class AstCache:
+
+    """On-disk cache of generalized ASTs, keyed by source code hash and transpyle version.
+
+    Trees are stored pickled and gzip-compressed, one file per entry. When the total size of
+    the cache exceeds max_size bytes, least recently used entries are removed.
+    """
+
+    def __init__(self, path: pathlib.Path, max_size: int = 1024 ** 3):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+
+    def _entry_path(self, code: str, suffix: str) -> pathlib.Path:
+        if self._version is None:
+            self._version = _transpyle_version()
+        key = hashlib.sha256('\0'.join((self._version, suffix, code)).encode()).hexdigest()
+        return self.path.joinpath(key + '.pickle.gz')
+
+    def get(self, code: str, suffix: str):
+        """Return cached tree for given code, or None if there is none."""
+        entry_path = self._entry_path(code, suffix)
+        try:
+            with gzip.open(str(entry_path), 'rb') as entry_file:
+                tree = pickle.load(entry_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(str(entry_path))
+        self.hits += 1
+        return tree
+
+    def put(self, code: str, suffix: str, tree) -> None:
+        entry_path = self._entry_path(code, suffix)
+        self.path.mkdir(parents=True, exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=str(self.path), suffix='.partial')
+        try:
+            with os.fdopen(handle, 'wb') as raw_file:
+                with gzip.GzipFile(fileobj=raw_file, mode='wb') as entry_file:
+                    pickle.dump(tree, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError) as err:
+            _LOG.warning('not caching AST that cannot be pickled: %s', err)
+            os.remove(temporary_path)
+            return
+        os.replace(temporary_path, str(entry_path))
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits within max_size."""
+        entries = []
+        for entry_path in self.path.glob('*.pickle.gz'):
+            try:
+                entries.append((entry_path.stat(), entry_path))
+            except FileNotFoundError:
+                continue
+        total_size = sum(stat.st_size for stat, _ in entries)
+        for stat, entry_path in sorted(entries, key=lambda _: _[0].st_mtime):
+            if total_size <= self.max_size:
+                break
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= stat.st_size
+
+    def stats(self) -> t.Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(list(self.path.glob('*.pickle.gz')))}
+
+
+AST_CACHE = AstCache(pathlib.Path(_HERE, 'ast_cache'))
+
+
+class ResidentFortranParser(FortranParser):
+
+    """Fortran parser that runs Open Fortran Parser in a JVM embedded in the current process.
+
+    FortranParser launches a new JVM for every file. This one starts the JVM (using JPype) on first
+    use and keeps it, together with the already JIT-compiled parser, for the lifetime of
+    the process. A JVM cannot be restarted, therefore this is meant for long-lived workers.
+    """
+
+    def _parse_scope(self, code: str, path: pathlib.Path = None) -> ET.Element:
+        assert path is not None, path
+        java_config = open_fortran_parser.config.JAVA
+        if not jpype.isJVMStarted():
+            jpype.startJVM(*(java_config['options'] or ()),
+                           classpath=[str(java_config['classpath'])], convertStrings=True)
+        front_end_class = jpype.JClass(java_config['ofp_class'])
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_path = pathlib.Path(output_dir, 'ofp.xml')
+            front_end = front_end_class(['--verbosity', '100', '--output', str(output_path)],
+                                        str(path), java_config['ofp_xml_class'])
+            if front_end.call():
+                raise RuntimeError('Open Fortran Parser failed to parse "{}"'.format(path))
+            front_end.getParser().getAction().cleanUp()
+            return ET.parse(str(output_path)).getroot()
+
+
+def _transpile_code(path: pathlib.Path, ast_cache: t.Optional[AstCache],
+                    parsers: t.Optional[dict] = None) -> t.Tuple[str, bool]:
+    """Read, parse, generalize and unparse Fortran code, but do not write it.
+
+    Instances of parser and generalizer are taken from parsers dict if it has them, and put there
+    otherwise, so that long-lived workers can reuse them.
+    """
+    if parsers is None:
+        parsers = {}
+    reader = CodeReader()
+    unparser = Fortran2008Unparser()
+
+    code = reader.read_file(path)
+    tree = None if ast_cache is None else ast_cache.get(code, path.suffix)
+    ast_cache_hit = tree is not None
+    if tree is None:
+        parser = parsers.setdefault('parser', FortranParser())
+        generalizer = parsers.setdefault('generalizer', FortranAstGeneralizer())
+        fortran_ast = parser.parse(code, path)
+        tree = generalizer.generalize(fortran_ast)
+        if ast_cache is not None:
+            ast_cache.put(code, path.suffix, tree)
+    return unparser.unparse(tree), ast_cache_hit
+
+
+def _write_transpiled(path: pathlib.Path, fortran_code: str):
+    writer = CodeWriter(path.suffix)
+    backup_path = path.with_suffix(path.suffix + '.bak')
+    if not backup_path.is_file():
+        pathlib.Path.rename(path, backup_path)
+    writer.write_file(fortran_code, path)
+
+
+def _transpiler_worker_loop(connection: multiprocessing.connection.Connection,
+                            ast_cache: t.Optional[AstCache]):
+    os.setpgrp()  # so that the pool can kill this worker together with its java subprocess
+    parsers = {}
+    if jpype is not None:
+        parsers['parser'] = ResidentFortranParser()
+    while True:
+        try:
+            path = connection.recv()
+        except EOFError:
+            break
+        if path is None:
+            break
+        lookups = (0, 0) if ast_cache is None else (ast_cache.hits, ast_cache.misses)
+        try:
+            fortran_code, ast_cache_hit = _transpile_code(path, ast_cache, parsers)
+            error = None
+        except Exception as err:  # reported back to the parent process
+            fortran_code, ast_cache_hit, error = None, False, '{}: {}'.format(
+                type(err).__name__, err)
+        if ast_cache is not None:
+            lookups = (ast_cache.hits - lookups[0], ast_cache.misses - lookups[1])
+        connection.send((fortran_code, ast_cache_hit, error, lookups))
+    connection.close()
+
+
+class TranspilerPool:
+
+    """Pool of long-lived worker processes that parse, generalize and unparse Fortran code.
+
+    Each worker keeps its parser and generalizer for its whole lifetime, and communicates with
+    the pool over a pipe. If JPype is installed, the parser is a ResidentFortranParser, so each
+    worker also keeps one JVM. A worker that crashes, or takes longer than timeout seconds for
+    one file, is killed if necessary (with all its subprocesses) and replaced by a new one.
+    AST cache lookups made by workers are counted in the pool's ast_cache.
+    """
+
+    def __init__(self, workers: int = 1, timeout: float = None,
+                 ast_cache: t.Optional[AstCache] = AST_CACHE):
+        self.workers = workers
+        self.timeout = timeout
+        self.ast_cache = ast_cache
+        self.restarts = 0
+        self._idle = []  # (process, connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start_worker(self):
+        parent_connection, child_connection = _FORK.Pipe()
+        process = _FORK.Process(target=_transpiler_worker_loop,
+                                args=(child_connection, self.ast_cache), daemon=True)
+        process.start()
+        child_connection.close()
+        return process, parent_connection
+
+    def _stop_worker(self, process, connection, kill: bool = False):
+        if kill:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:  # worker didn't create its process group yet
+                process.kill()
+        else:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        connection.close()
+        process.join()
+
+    def transpile_many(self, paths: t.Iterable[pathlib.Path]) -> t.Iterator[dict]:
+        """Transpile code of given files concurrently, and yield results as they come.
+
+        Result is a dict with keys: path, fortran_code (None in case of failure),
+        status ("ok", "failed" or "timeout"), time (in seconds), error and ast_cache_hit.
+        """
+        pending = list(reversed(list(paths)))
+        busy = {}  # connection -> (process, path, start time)
+        try:
+            while pending or busy:
+                while pending and len(busy) < self.workers:
+                    process, connection = self._idle.pop() if self._idle else self._start_worker()
+                    path = pending.pop()
+                    connection.send(path)
+                    busy[connection] = (process, path, time.perf_counter())
+                wait_timeout = None
+                if self.timeout is not None:
+                    now = time.perf_counter()
+                    wait_timeout = max(0, min(
+                        start + self.timeout - now for _, _, start in busy.values()))
+                for connection in multiprocessing.connection.wait(list(busy), timeout=wait_timeout):
+                    process, path, start = busy.pop(connection)
+                    try:
+                        fortran_code, ast_cache_hit, error, lookups = connection.recv()
+                    except EOFError:
+                        process.join()
+                        fortran_code, ast_cache_hit, error = None, False, \
+                            'worker exited with code {}'.format(process.exitcode)
+                        _LOG.warning('transpiler worker crashed on "%s", restarting', path)
+                        self._stop_worker(process, connection)
+                        self.restarts += 1
+                    else:
+                        self._idle.append((process, connection))
+                        if self.ast_cache is not None:
+                            self.ast_cache.hits += lookups[0]
+                            self.ast_cache.misses += lookups[1]
+                    yield {'path': str(path), 'fortran_code': fortran_code,
+                           'status': 'ok' if error is None else 'failed',
+                           'time': time.perf_counter() - start, 'error': error,
+                           'ast_cache_hit': ast_cache_hit}
+                if self.timeout is not None:
+                    now = time.perf_counter()
+                    for connection, (process, path, start) in list(busy.items()):
+                        if now - start > self.timeout:
+                            del busy[connection]
+                            _LOG.warning('transpiler worker timed out on "%s", restarting', path)
+                            self._stop_worker(process, connection, kill=True)
+                            self.restarts += 1
+                            yield {'path': str(path), 'fortran_code': None, 'status': 'timeout',
+                                   'time': now - start,
+                                   'error': 'exceeded {} seconds'.format(self.timeout),
+                                   'ast_cache_hit': False}
+        finally:
+            for connection, (process, _, _) in busy.items():
+                self._stop_worker(process, connection, kill=True)
+
+    def transpile(self, path: pathlib.Path) -> str:
+        """Transpile code of a single file, and raise RuntimeError if it fails."""
+        result, = self.transpile_many([path])
+        if result['status'] != 'ok':
+            raise RuntimeError('transpiling "{}" failed: {}'.format(path, result['error']))
+        return result['fortran_code']
+
+    def close(self):
+        while self._idle:
+            self._stop_worker(*self._idle.pop())
+
+
+def fortran_to_fortran(path: pathlib.Path, ast_cache: t.Optional[AstCache] = AST_CACHE,
+                       pool: t.Optional[TranspilerPool] = None):
+    """Transpile Fortran to Fortran, using Python AST as intermediate (generalized) format.
+
+    Reader reads the code.
+    Parser creates a Fortran-specific AST.
+    Generalizer transforms it into AST that can be easily processed and unparsed into many outputs.
+    Generalized AST is taken from ast_cache instead, if the same code was processed before.
+    Unparsers creates Fortran code from the same generalized AST.
+    Original file is moved from "name.ext" to "name.ext.bak", unless the backup already exists.
+    Writer writes the transpiled file to where the original file was.
+
+    If pool is given, all but writing is done by one of its long-lived workers, and the pool's
+    ast_cache is used instead.
+    """
+    if pool is None:
+        fortran_code, _ = _transpile_code(path, ast_cache)
+    else:
+        fortran_code = pool.transpile(path)
+    _write_transpiled(path, fortran_code)
+
+
+def find_fortran_files(paths: t.Iterable[pathlib.Path]) -> t.List[pathlib.Path]:
+    """Expand directories into Fortran source files they contain, recursively."""
+    found = []
+    for path in paths:
+        if path.is_dir():
+            found += sorted(_ for _ in path.glob('**/*') if _.suffix in FORTRAN_SUFFIXES)
+        else:
+            found.append(path)
+    return found
+
+
+def transpile_batch(paths: t.Sequence[pathlib.Path], workers: int = None, timeout: float = None,
+                    summary_path: pathlib.Path = None,
+                    ast_cache: t.Optional[AstCache] = AST_CACHE) -> t.List[dict]:
+    """Transpile many Fortran files in parallel, using a TranspilerPool.
+
+    Written files follow the same ".bak" backup semantics as in fortran_to_fortran().
+    A file that takes longer than timeout seconds is abandoned and its original is kept.
+    Result for each file is a dict with keys: path, status ("ok", "failed" or "timeout"),
+    time (in seconds), error and ast_cache_hit.
+    If summary_path is given, results are also written there as JSON.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    results = []
+    with TranspilerPool(workers, timeout, ast_cache) as pool:
+        for result in pool.transpile_many(paths):
+            fortran_code = result.pop('fortran_code')
+            if fortran_code is not None:
+                try:
+                    _write_transpiled(pathlib.Path(result['path']), fortran_code)
+                except OSError as err:
+                    result.update(status='failed', error='{}: {}'.format(type(err).__name__, err))
+            _LOG.info('%s: %s', result['path'], result['status'])
+            results.append(result)
+        _LOG.info('transpiler workers were restarted %i times', pool.restarts)
+
+    if summary_path is not None:
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        with summary_path.open('w') as summary_file:
+            json.dump(results, summary_file, indent=2)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Transpile Fortran files and/or directories with Fortran files in place.')
+    parser.add_argument('paths', metavar='PATH', type=pathlib.Path, nargs='+')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help='per-file timeout in seconds')
+    parser.add_argument('-s', '--summary', type=pathlib.Path, default=None,
+                        help='where to write JSON summary (default: in results folder)')
+    parser.add_argument('--no-ast-cache', action='store_true',
+                        help='always parse the code, ignoring cached ASTs')
+    parsed_args = parser.parse_args(args)
+
+    common._NOW = datetime.datetime.now()
+    summary_path = parsed_args.summary
+    if summary_path is None:
+        summary_path = logs_path(test_name='transpile').joinpath('summary.json')
+    paths = find_fortran_files(parsed_args.paths)
+    _LOG.warning('transpiling %i files...', len(paths))
+    results = transpile_batch(paths, parsed_args.workers, parsed_args.timeout, summary_path,
+                              None if parsed_args.no_ast_cache else AST_CACHE)
+    failures = [result for result in results if result['status'] != 'ok']
+    _LOG.warning('transpiled %i of %i files, summary was written to "%s"',
+                 len(results) - len(failures), len(results), summary_path)
+    if not parsed_args.no_ast_cache:
+        _LOG.warning('AST cache: %s', AST_CACHE.stats())
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    raise SystemExit(main())